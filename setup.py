@@ -15,7 +15,6 @@ setup(
     install_requires=['docopt',
                       'Pillow',
                       'numpy',
-                      'matplotlib',
                       'requests'
                       ],
     entry_points={
@@ -0,0 +1,237 @@
+from hashlib import sha1
+from collections import OrderedDict
+import threading
+import logging
+import time
+import os
+
+loger = logging.getLogger('cache')
+loger.setLevel(logging.WARNING)
+
+
+class DiskCache:
+    """
+    On-disk cache of HTTP response bodies. Entries are files named by
+    the SHA1 of the request URL and query, sharded into directories
+    '_xx' by the first two hex characters like panorama files. Every
+    entry has a kind (endpoint type) with its own time to live. The
+    total size is bounded, least recently used entries are evicted.
+    Recency survives restarts as the access time of the files, the
+    modification time is the time the entry was written.
+
+    Processes sharing the directory (see sharded) take disjoint
+    partitions of keys. A partitioned cache indexes and evicts only
+    its own existing entries and the ones it writes itself, entries
+    read from other partitions are never evicted by it.
+    """
+    # Time to live in seconds per kind, None - never expires
+    ttl = {
+        'panoid':       24*3600,        # closest panorama of a location
+        'meta':         30*24*3600,
+        'time_meta':    7*24*3600,      # new temporal links appear
+        'tile':         None            # image of a pano id never changes
+    }
+
+    # Checks of bodies per kind, e.g. an error page instead of a tile is not stored
+    accept = {
+        'tile':         lambda data: data.startswith('\xff\xd8')    # JPEG SOI marker
+    }
+
+    def __init__(self, root, max_size=20*2**30, ttl=None, part=None):
+        """
+        :param root: string - cache directory
+        :param max_size: int - max. total size of entries in bytes
+        :param ttl: dictionary - kind -> seconds, overrides default ttl
+        :param part: tuple (i, n) - i-th of n partitions, None - all keys
+        """
+        self.root = root
+        self.part = part
+        self.max_size = max_size
+        self.ttl = dict(self.ttl)
+        self.ttl.update(ttl or {})
+        self.lock = threading.Lock()
+        self.index = {}             # path -> (size, last access)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._scan()
+
+    def _scan(self):
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        for dpath, dnames, fnames in os.walk(self.root):
+            for f in fnames:
+                path = os.path.join(dpath, f)
+                if f.endswith('.tmp'):
+                    if self.owns(f):
+                        os.remove(path)         # interrupted write
+                    continue
+                if not self.owns(f):
+                    continue
+                st = os.stat(path)
+                self.index[path] = (st.st_size, st.st_atime)
+                self.size += st.st_size
+        self._evict()
+
+    def owns(self, key):
+        """
+        :param key: string - see key(), file name of the entry
+        :return: bool - True if the key is in the partition of the cache
+        """
+        if self.part is None:
+            return True
+        i, n = self.part
+        try:
+            return int(key[:8], 16) % n == i
+        except ValueError:
+            return False
+
+    def key(self, url, query_str):
+        """
+        :param url: string - base URL
+        :param query_str: string - url encoded query
+        :return: string - hex digest
+        """
+        return sha1(url + '?' + query_str).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, '_' + key[:2], key)
+
+    def get(self, key, kind):
+        """
+        :param key: string - see key()
+        :param kind: string - endpoint type, see ttl
+        :return: string - cached body or None if missing or expired
+        """
+        path = self.path(key)
+        try:
+            mtime = os.path.getmtime(path)
+            ttl = self.ttl.get(kind)
+            if ttl is not None and time.time() - mtime > ttl:
+                self._remove(path)
+                data = None
+            else:
+                with open(path, 'rb') as f:
+                    data = f.read()
+        except (IOError, OSError):
+            data = None
+
+        with self.lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            now = time.time()
+            if path in self.index:
+                self.index[path] = (self.index[path][0], now)
+        try:
+            os.utime(path, (now, mtime))        # keeps write time for ttl
+        except OSError:
+            pass
+        return data
+
+    def put(self, key, kind, data):
+        """
+        Stores response body, the entry is written aside and renamed
+        in place, readers never see a partial file.
+        :param key: string - see key()
+        :param kind: string - endpoint type, see ttl
+        :param data: string - response body
+        """
+        accept = self.accept.get(kind)
+        if accept and not accept(data):
+            return
+        path = self.path(key)
+        tmp = '%s.%d.tmp' % (path, threading.current_thread().ident)
+        try:
+            d = os.path.dirname(path)
+            if not os.path.exists(d):
+                try:
+                    os.makedirs(d)
+                except OSError:
+                    pass                        # created by another thread
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.rename(tmp, path)
+        except (IOError, OSError) as e:
+            loger.warning('Cache write failed %s - %s: %s' % (path, type(e).__name__, str(e)))
+            return
+
+        with self.lock:
+            old = self.index.get(path)
+            if old:
+                self.size -= old[0]
+            self.index[path] = (len(data), time.time())
+            self.size += len(data)
+            self._evict()
+
+    def _evict(self):
+        # lock held, drops the least recently used entries
+        if self.size <= self.max_size:
+            return
+        target = 0.9 * self.max_size            # evict in batches
+        for path, (size, atime) in sorted(self.index.items(), key=lambda x: x[1][1]):
+            if self.size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            del self.index[path]
+            self.size -= size
+
+    def _remove(self, path):
+        with self.lock:
+            item = self.index.pop(path, None)
+            if item:
+                self.size -= item[0]
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+class MemoryCache:
+    """
+    Thread-safe LRU of parsed objects, e.g. panorama metadata by
+    pano id. At most maxsize entries are kept. Cached objects are
+    shared, callers must not modify them.
+    """
+    def __init__(self, maxsize=256):
+        """
+        :param maxsize: int - max. No. of entries
+        """
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        :return: cached object or None
+        """
+        with self.lock:
+            val = self.items.pop(key, None)
+            if val is None:
+                self.misses += 1
+                return None
+            self.items[key] = val           # most recently used last
+            self.hits += 1
+            return val
+
+    def put(self, key, val):
+        if val is None:
+            return
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = val
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def __len__(self):
+        return len(self.items)
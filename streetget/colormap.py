@@ -0,0 +1,67 @@
+import numpy as np
+
+# Viridis (matplotlib default colormap) sampled at 0, 1/16, ..., 1
+_viridis = [
+    (68, 1, 84),
+    (72, 24, 106),
+    (71, 45, 123),
+    (66, 64, 134),
+    (59, 82, 139),
+    (51, 99, 141),
+    (44, 114, 142),
+    (38, 130, 142),
+    (33, 145, 140),
+    (31, 160, 136),
+    (40, 174, 128),
+    (63, 188, 115),
+    (94, 201, 98),
+    (132, 212, 75),
+    (173, 220, 48),
+    (216, 226, 25),
+    (253, 231, 37)
+]
+
+def lut(points, n=256):
+    """
+    Builds a color lookup table by linear interpolation
+    of equidistant control points.
+    :param points: list of tuples (r, g, b) - control colors
+    :param n: int - number of table entries
+    :return: numpy.ndarray - n x 3 uint8 table
+    """
+    points = np.array(points, np.float64)
+    xp = np.linspace(0, 1, len(points))
+    x = np.linspace(0, 1, n)
+    table = [np.interp(x, xp, points[:, c]) for c in range(3)]
+    return np.round(np.array(table).T).astype(np.uint8)
+
+viridis = lut(_viridis)
+
+def colorize(a, table=viridis, vmin=None, vmax=None):
+    """
+    Maps values of a 2D array to colors of the lookup table.
+    Values are scaled linearly between vmin and vmax, by
+    default the min. and max. of the finite values. NaN and
+    inf values are transparent.
+    :param a: numpy.ndarray - h x w values
+    :param table: numpy.ndarray - n x 3 uint8 lookup table
+    :param vmin: float - value mapped to the first color
+    :param vmax: float - value mapped to the last color
+    :return: numpy.ndarray - h x w x 4 uint8 RGBA
+    """
+    valid = np.isfinite(a)
+    rgba = np.zeros(a.shape + (4,), np.uint8)
+    if not valid.any():
+        return rgba
+
+    vals = a[valid]
+    vmin = vals.min() if vmin is None else vmin
+    vmax = vals.max() if vmax is None else vmax
+
+    n = len(table)
+    scale = n / float(vmax - vmin) if vmax > vmin else 0.
+    idx = np.clip((vals - vmin) * scale, 0, n-1).astype(np.intp)
+
+    rgba[valid, :3] = table[idx]
+    rgba[valid, 3] = 255
+    return rgba
@@ -0,0 +1,336 @@
+"""
+Memory-compact containers for crawl state. Regular pano ids are
+22 characters of url-safe base64, i.e. 16 bytes of data. They are
+stored decoded in flat byte arrays instead of Python strings. Ids
+that do not decode (e.g. custom panoramas) fall back to ordinary
+Python set/dict.
+"""
+from array import array
+from struct import Struct
+from zlib import crc32
+import base64
+import math
+import numpy as np
+
+_empty = 16 * '\0'
+_halves = Struct('< 2Q')
+
+def encodeKey(pano_id):
+    """
+    :param pano_id: string - pano id hash
+    :return: string - 16 bytes or None if pano id is not
+             a regular 22 characters base64 hash
+    """
+    if len(pano_id) != 22:
+        return None
+    try:
+        pano_id = str(pano_id)
+        k = base64.urlsafe_b64decode(pano_id + '==')
+    except (TypeError, ValueError, UnicodeError):
+        return None
+    if k == _empty or base64.urlsafe_b64encode(k)[:22] != pano_id:
+        return None                     # non-canonical, would not round trip
+    return k
+
+def decodeKey(k):
+    """
+    :param k: string - 16 bytes key given by encodeKey()
+    :return: string - pano id hash
+    """
+    return base64.urlsafe_b64encode(str(k))[:22]
+
+def _capacity(n, load):
+    return 1 << max(4, int(math.ceil(math.log(n / load + 1, 2))))
+
+
+class BloomFilter(object):
+    """
+    Bloom filter over 16 bytes keys. Keys are random data, hence
+    its two 64 bit halves serve as independent hashes.
+    """
+    def __init__(self, capacity, error=0.01):
+        """
+        :param capacity: int - expected No. of keys
+        :param error: float - false positive rate at capacity
+        """
+        m = int(-capacity * math.log(error) / math.log(2)**2) + 8
+        self.m = m
+        self.k = max(1, int(round(m / float(capacity) * math.log(2))))
+        self.bits = bytearray((m + 7) // 8)
+
+    def _bits(self, k):
+        h1, h2 = _halves.unpack(k)
+        h2 |= 1
+        return [(h1 + i*h2) % self.m for i in range(self.k)]
+
+    def add(self, k):
+        for b in self._bits(k):
+            self.bits[b >> 3] |= 1 << (b & 7)
+
+    def __contains__(self, k):
+        for b in self._bits(k):
+            if not self.bits[b >> 3] & (1 << (b & 7)):
+                return False
+        return True
+
+    def copy(self):
+        other = BloomFilter.__new__(BloomFilter)
+        other.m, other.k = self.m, self.k
+        other.bits = bytearray(self.bits)
+        return other
+
+
+class KeySet(object):
+    """
+    Set of pano ids. Decoded 16 bytes keys are kept in an open
+    addressing hash table (linear probing) backed by one bytearray,
+    about 21 bytes per id at full load compared to ~100 bytes of
+    a Python set of strings. Optional Bloom filter in front of the
+    table answers most misses without probing.
+    """
+    load = 0.75                 # max. load factor before growing
+
+    def __init__(self, capacity=1024, bloom=None):
+        """
+        :param capacity: int - expected No. of ids
+        :param bloom: int - expected No. of ids for a Bloom filter
+                      front, None for no filter
+        """
+        self.cap = _capacity(capacity, self.load)
+        self.keys = bytearray(16 * self.cap)
+        self.n = 0
+        self.extra = set()
+        self.bloom = BloomFilter(bloom) if bloom else None
+
+    def _find(self, k, keys=None):
+        keys = self.keys if keys is None else keys
+        mask = len(keys) // 16 - 1             # of the table probed, see _grow()
+        i = crc32(k) & mask
+        while True:
+            s = keys[16*i:16*i+16]
+            if s == k:
+                return i, True
+            if s == _empty:
+                return i, False
+            i = (i + 1) & mask
+
+    def _grow(self):
+        # New table is filled aside, readers see either table whole
+        keys = bytearray(32 * self.cap)
+        for k in self.occupied():
+            i, _ = self._find(k, keys)
+            keys[16*i:16*i+16] = k
+        self.keys = keys
+        self.cap *= 2
+
+    def occupied(self, keys=None, block=1 << 16):
+        """
+        Iterates over 16 bytes keys stored in the table.
+        :param keys: bytearray - table, default the current one
+        :param block: int - No. of slots scanned at once
+        """
+        keys = self.keys if keys is None else keys
+        a = np.frombuffer(keys, np.uint8).reshape((-1, 16))
+        for j in xrange(0, len(a), block):
+            for i in np.flatnonzero(a[j:j+block].any(axis=1)) + j:
+                yield str(keys[16*i:16*i+16])
+
+    def add(self, key):
+        k = encodeKey(key)
+        if k is None:
+            self.extra.add(key)
+            return
+        i, found = self._find(k)
+        if found:
+            return
+        self.keys[16*i:16*i+16] = k
+        self.n += 1
+        if self.bloom:
+            self.bloom.add(k)
+        if self.n > self.load * self.cap:
+            self._grow()
+
+    def __contains__(self, key):
+        k = encodeKey(key)
+        if k is None:
+            return key in self.extra
+        if self.bloom and k not in self.bloom:
+            return False
+        return self._find(k)[1]
+
+    def __len__(self):
+        return self.n + len(self.extra)
+
+    def __iter__(self):
+        for k in self.occupied():
+            yield decodeKey(k)
+        for key in list(self.extra):
+            yield key
+
+    def copy(self):
+        other = KeySet.__new__(KeySet)
+        other.cap, other.n = self.cap, self.n
+        other.keys = bytearray(self.keys)
+        other.extra = set(self.extra)
+        other.bloom = self.bloom.copy() if self.bloom else None
+        return other
+
+
+class VisitedRecords(object):
+    """
+    Dictionary like store of visited panoramas:
+        pano_id -> {'latlng': (lat, lng), 'date': (year, month)}
+    Records are kept as struct of arrays - float64 latitudes and
+    longitudes, uint16 packed dates and 16 bytes keys per row. Rows
+    are indexed by an open addressing table of uint32 row numbers.
+    Missing (None) coordinates are stored as NaN, missing date as 0.
+    """
+    load = 0.75
+
+    def __init__(self, capacity=1024):
+        self.cap = _capacity(capacity, self.load)
+        self.slots = array('I', [0]) * self.cap     # row + 1, 0 empty
+        self.rowkeys = bytearray()                  # 16 bytes per row
+        self.lat = array('d')
+        self.lng = array('d')
+        self.date = array('H')                      # year*12 + month, 0 unknown
+        self.extra = {}
+
+    def _find(self, k, slots=None):
+        slots = self.slots if slots is None else slots
+        keys = self.rowkeys
+        mask = len(slots) - 1                   # of the table probed, see _grow()
+        i = crc32(k) & mask
+        while True:
+            row = slots[i]
+            if row == 0:
+                return i, None
+            row -= 1
+            if keys[16*row:16*row+16] == k:
+                return i, row
+            i = (i + 1) & mask
+
+    def _grow(self):
+        # New index is filled aside, readers see either index whole
+        slots = array('I', [0]) * (2 * self.cap)
+        keys = self.rowkeys
+        for row in xrange(len(self.lat)):
+            i, _ = self._find(str(keys[16*row:16*row+16]), slots)
+            slots[i] = row + 1
+        self.slots = slots
+        self.cap *= 2
+
+    @staticmethod
+    def _pack(val):
+        lat, lng = val['latlng']
+        year, month = val['date']
+        lat = float('nan') if lat is None else lat
+        lng = float('nan') if lng is None else lng
+        date = 0 if year is None or month is None else year*12 + month
+        return lat, lng, date
+
+    def _record(self, row):
+        lat, lng, date = self.lat[row], self.lng[row], self.date[row]
+        ll = (None if lat != lat else lat, None if lng != lng else lng)
+        dd = (None, None) if date == 0 else divmod(date - 1, 12)
+        if date:
+            dd = (dd[0], dd[1] + 1)
+        return {'latlng': ll, 'date': dd}
+
+    def __setitem__(self, key, val):
+        k = encodeKey(key)
+        if k is None:
+            self.extra[key] = val
+            return
+        lat, lng, date = self._pack(val)
+        i, row = self._find(k)
+        if row is not None:
+            self.lat[row], self.lng[row], self.date[row] = lat, lng, date
+            return
+        self.rowkeys.extend(k)
+        self.lat.append(lat)
+        self.lng.append(lng)
+        self.date.append(date)
+        self.slots[i] = len(self.lat)
+        if len(self.lat) > self.load * self.cap:
+            self._grow()
+
+    def __getitem__(self, key):
+        k = encodeKey(key)
+        if k is None:
+            return self.extra[key]
+        _, row = self._find(k)
+        if row is None:
+            raise KeyError(key)
+        return self._record(row)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        k = encodeKey(key)
+        if k is None:
+            return key in self.extra
+        return self._find(k)[1] is not None
+
+    def __len__(self):
+        return len(self.lat) + len(self.extra)
+
+    def iteritems(self):
+        keys = self.rowkeys
+        for row in xrange(len(self.lat)):
+            yield decodeKey(keys[16*row:16*row+16]), self._record(row)
+        for item in self.extra.items():
+            yield item
+
+    def __iter__(self):
+        for key, _ in self.iteritems():
+            yield key
+
+    def keys(self):
+        return list(self)
+
+    def latlngs(self):
+        """
+        Positions of all records at once, e.g. for bulk validation,
+        see validator.validate_many().
+        :return: tuple (list of pano ids, numpy.ndarray - n x 2 lat, lng
+                 float64, NaN if unknown) in the same order
+        """
+        lls = np.empty((len(self), 2))
+        n = len(self.lat)
+        lls[:n, 0] = np.frombuffer(self.lat, np.float64)
+        lls[:n, 1] = np.frombuffer(self.lng, np.float64)
+        keys = [decodeKey(self.rowkeys[16*row:16*row+16]) for row in xrange(n)]
+        for i, (key, val) in enumerate(self.extra.iteritems()):
+            keys.append(key)
+            lls[n+i] = [np.nan if x is None else x for x in val['latlng']]
+        return keys, lls
+
+    def copy(self):
+        other = VisitedRecords.__new__(VisitedRecords)
+        other.cap = self.cap
+        other.slots = self.slots[:]
+        other.rowkeys = bytearray(self.rowkeys)
+        other.lat = self.lat[:]
+        other.lng = self.lng[:]
+        other.date = self.date[:]
+        other.extra = dict(self.extra)
+        return other
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for name in ('slots', 'lat', 'lng', 'date'):
+            a = state[name]
+            state[name] = (a.typecode, a.tostring())   # array pickles as a list
+        return state
+
+    def __setstate__(self, state):
+        for name in ('slots', 'lat', 'lng', 'date'):
+            typecode, data = state[name]
+            state[name] = array(typecode)
+            state[name].fromstring(data)
+        self.__dict__.update(state)
@@ -1,10 +1,15 @@
+from queue import Queue, Empty
 import threading
 import os
 import logging
 import validator
-import shutil
 from panorama import Panorama
-from database import Database
+import panorama
+from database import JournalDatabase, SqliteDatabase
+from session import SessionPool
+from cache import DiskCache
+from tiles import TileEngine
+import session
 import time
 
 loger = logging.getLogger('crawler')
@@ -13,11 +18,18 @@ loger.setLevel(logging.DEBUG)
 class Crawler:
     t_save  = 300                # backup db every 5min
     n_thr   = 4                  # No. of crawling threads
+    n_conn  = 32                 # max. keep-alive connections per host
+    n_tiles = 32                 # No. of tile threads shared by the crawl
+    link_step = 10               # [m] assumed distance of linked panoramas
+    media_backlog = 64           # discovered panoramas waiting for media download
 
     def __init__(self,
                     latlng=None, pano_id=None, validator=None,
                     root='myData', label='myCity', zoom=5,
-                    images=False, depth=False, time=True, skip=False
+                    images=False, depth=False, time=True, skip=False,
+                    async_images=False, n_tiles=None, raw_tiles=False,
+                    depth_json=False, backend='journal', nearest=False,
+                    cache=None, rate=None, n_media=None, prune_slack=None
                  ):
         if not latlng and not pano_id:
             raise ValueError('start point (latlng or pano_id) not given')
@@ -25,41 +37,86 @@ class Crawler:
         loger.info('___ Crawler starting ___')
 
         self.dir = os.path.join(root, label)
-        self.fname = os.path.join(root, label, 'db.pickle')
+        self.fname = os.path.join(root, label, 'db.pickle')    # legacy snapshot
         self.fname_bck = self.fname + '.bck'
 
         self.zoom = zoom if isinstance(zoom, list) else [zoom]  # zoom must be a list
         self.start_id = pano_id
         self.start_latlng = latlng
         self.inArea = validator
-
-        self.db = Database()
+        self.precheck = getattr(validator, 'precheck', None)
+        self.prune_slack = prune_slack          # [m] None - no pruning, see discover()
+        self.n_pruned = 0                       # neighbours never fetched
+
+        # Nearest-first crawling, frontier is ordered by the estimated
+        # distance of panoramas from the area origin
+        self.nearest = nearest
+        if nearest and not hasattr(validator, 'distance'):
+            raise ValueError('nearest-first crawling needs a validator with distance()')
+
+        # Crawl state: snapshot + journal, or SQLite db
+        if backend == 'sqlite':
+            self.db = SqliteDatabase(os.path.join(root, label, 'db.sqlite'), nearest)
+        elif backend == 'journal':
+            self.db = JournalDatabase(os.path.join(root, label, 'db'), nearest)
+        elif backend is None:
+            self.db = None                      # remote worker, see distributed
+        else:
+            raise ValueError('Unknown database backend: %s' % (backend,))
         self.threads = self.n_thr * [None]      # thread vector allocation
+        self.media_threads = []
         self.exit_flag = False                  # flag for signaling threads
 
         self.images = images
         self.depth = depth
+        self.depth_json = depth_json            # JSON export instead of binary
         self.time = time
+        self.skip = skip                        # keep already saved files
+
+        # Staged pipeline, crawling threads only discover panoramas,
+        # images and depth are saved by n_media threads. A panorama
+        # is done once its media is saved.
+        self.n_media = n_media if n_media and (images or depth) else 0
+        self.media = Queue(self.media_backlog)  # (Panorama, path prefix)
+
+        # Images of all panoramas are fetched by one long-lived tile
+        # engine. In async mode crawling threads do not wait for images.
+        self.async_images = async_images
+        self.n_tiles = n_tiles or self.n_tiles
+        self.tiles = TileEngine(self.n_tiles)
+        self.raw_tiles = raw_tiles              # tar of JPEG tiles, no stitching
+
+        # One connection pool shared by crawling and tile threads,
+        # responses optionally cached on the disk
+        self.cache = DiskCache(cache) if cache else None
+        self.pool = SessionPool(pool_maxsize=max(self.n_conn, self.n_tiles),
+                                cache=self.cache, rate=rate)
+        session.setDefault(self.pool)
 
         if not os.path.exists(self.dir):        # create dir
             os.makedirs(self.dir)
 
-        if os.path.exists(self.fname):          # resume existing crawler db
+        if self.db is None:
+            return
+        resume = self.db.exists()
+        self.db.open()                          # resumes existing crawler db
+        if resume:
+            loger.info('Crawl state recovered')
+        elif os.path.exists(self.fname):        # resume legacy pickled db
             if not self.load(self.fname):
                 self.load(self.fname_bck)       # roll back to backup
         else:                                   # new  crawler db
-            p = Panorama(self.start_id, self.start_latlng)
+            p = Panorama(self.start_id, self.start_latlng, pool=self.pool)
             self.db.enqueue(p.pano_id)          # starting panorama into a queue
 
-    def save(self, fname):
+    def save(self):
         try:
-            self.db.save(fname)
-            loger.info('db saved to ' + fname)
+            self.db.save()
+            loger.info('db saved')
         except Exception as e:
-            msg1 = 'Non-zero active thread chcksum while saving.\n'
-            msg2 = '%s: %s\ndb.active = %d' % (type(e).__name__, str(e), self.db.active())
-            loger.warining(msg1 + msg2)
-            print 'Warning: %s' % (msg1,)
+            msg = 'db saving failed! %s:%s' % (type(e).__name__, str(e))
+            loger.error(msg)
+            print 'Warning: %s' % (msg,)
 
     def load(self, fname):
         try:
@@ -71,33 +128,72 @@ class Crawler:
         return False
     
     def backup(self):
-        loger.debug('Bacingk up')
-        self.stopThreads()
-        try:
-            self.save(self.fname)
-            shutil.copyfile(self.fname, self.fname_bck)
-        finally:
-            self.startThreads()
+        """
+        Checkpoints the crawl state while worker threads keep
+        running. Snapshot is written in background, see
+        JournalDatabase.compact().
+        """
+        loger.debug('Backing up')
+        self.db.checkpoint()
 
     def visitPano(self, p):
         """
         Visits panorama, extracts meta data and adds
         info about panorama into database. Neighbour
-        panoramas are added to the database queue.
+        panoramas are added to the database queue unless
+        their estimated position is clearly outside the area.
         """
-        if not (p and p.isValid() and self.inArea(p)):
-            return
+        data, neighbours = self.discover(p)
+        for n, prio in neighbours:
+            self.db.enqueue(n, prio)        # update queue
+        if data:
+            self.db.add(p.pano_id, data)    # update visited db
 
-        neighbours = p.getAllNeighbours() if self.time else p.getSpatialNeighbours()
-        for n in neighbours:
-            self.db.enqueue(n)            # update queue
+    def discover(self, p):
+        """
+        Extracts meta data and neighbours of the panorama
+        without touching the database, see visitPano().
+        If prune_slack is set, neighbours estimated outside the area
+        widened by prune_slack are never fetched. Links carry only
+        a heading, the estimate is link_step meters from the
+        panorama, hence a slack of link_step or more would prune
+        nothing. Pruning is lossy: a panorama inside the area closer
+        than about link_step to its edge is missed if it is
+        reachable only through links estimated outside. Off by
+        default.
+        :param p: Panorama - object
+        :return: tuple (dictionary - visited record or None,
+                 list of (pano_id, priority) neighbours to be queued)
+        """
+        if not (p and p.isValid() and self.inArea(p)):
+            return None, []
+
+        neighbours = p.getNeighbourLocations(self.time, self.link_step)
+        queued = []
+        if neighbours:
+            ll0 = p.getGPS()
+            lls = [ll0 if None in ll else ll for n, ll in neighbours]
+
+            # all neighbours checked at once, see validator.validate_many
+            inside = [True] * len(lls)
+            if self.precheck and self.prune_slack is not None:
+                inside = self.precheck(lls, self.prune_slack)
+            priority = [0] * len(lls)
+            if self.nearest:
+                priority = self.inArea.distance(lls)
+
+            for (n, ll), ok, prio in zip(neighbours, inside, priority):
+                if not ok:
+                    self.n_pruned += 1      # not fetched at all
+                    continue
+                queued.append((n, float(prio)))
 
         if p.isCustom():
-            return                        # not Google panorama
+            return None, queued             # not Google panorama
 
         data = {'latlng': p.getGPS(), 'date': p.getDate()}
-        self.db.add(p.pano_id, data)      # update visited db
-        
+        return data, queued
+
     def savePano(self, p, zoom):
         """
         Saves panorama image at given zoom-level and its
@@ -106,44 +202,100 @@ class Crawler:
         :param p: Panorama - object
         :param zoom: int [0-5] iterable - zoom levels
         """
-        n_threads = 4
+        pbase = self.panoBase(p)
+        if pbase:
+            self.savePanoMeta(p, pbase)
+            self.savePanoMedia(p, pbase, zoom)
 
+    def panoBase(self, p):
+        """
+        :param p: Panorama - object
+        :return: string - path prefix of panorama files, the directory
+                 is created, None if the panorama is not saved
+        """
         if not (p and p.isValid() and self.inArea(p)):
-            return
+            return None
 
         if p.isCustom():
-            return          # not Google panorama
+            return None     # not Google panorama
 
         pdir = os.path.join(self.dir, '_' + p.pano_id[0:2])
         pname = p.pano_id
-        pbase = os.path.join(pdir, pname)
 
         if not os.path.exists(pdir):
-            os.makedirs(pdir)
+            try:
+                os.makedirs(pdir)
+            except OSError:
+                pass        # created by another thread
+        return os.path.join(pdir, pname)
 
+    def savePanoMeta(self, p, pbase):
+        """
+        Saves metadata of the panorama, see panoBase().
+        """
         fname = pbase + '_meta.json'
         if not (os.path.exists(fname) and self.skip):
             p.saveMeta(fname)
 
         fname = pbase + '_time_meta.json'
-        if not (os.path.exists(fname) and self.skip):
-            p.saveTimeMeta(fname)
-
-        if self.images:
-            for z in zoom:
-                if p.hasZoom(z):
-                    fname = pbase + '_zoom_' + str(z) + '.jpg'
-                    if not (os.path.exists(fname) and self.skip):
-                        p.saveImage(fname, z, n_threads)
-        dzoom = 0
-        if self.depth:
-            fname = pbase+'_depth.json'
-            if not (os.path.exists(fname) and self.skip):
-                p.saveDepthData(fname)
-
-            fname = pbase+'_zoom_0_depth.jpg'
-            if not (os.path.exists(fname) and self.skip):
-                p.saveDepthImage(fname, dzoom)
+        if self.time and not (os.path.exists(fname) and self.skip):
+            p.saveTimeMeta(fname)       # fetched only in time machine mode
+
+    def savePanoMedia(self, p, pbase, zoom, done=None):
+        """
+        Saves images and depth data of the panorama, see panoBase().
+        :param zoom: int [0-5] iterable - zoom levels
+        :param done: function() - called once all media is written or
+                     failed, in async mode from a tile thread after
+                     the last image
+        """
+        pending = [1]                       # this call and images in flight
+        lock = threading.Lock()
+
+        def finished(job=None):
+            with lock:
+                pending[0] -= 1
+                last = not pending[0]
+            if last and done:
+                done()
+
+        try:
+            if self.images:
+                for z in zoom:
+                    if not p.hasZoom(z):
+                        continue
+                    ext = '.tar' if self.raw_tiles else '.jpg'
+                    fname = pbase + '_zoom_' + str(z) + ext
+                    if os.path.exists(fname) and self.skip:
+                        continue
+                    if not self.async_images:
+                        if self.raw_tiles:
+                            p.saveTiles(fname, z, self.tiles)
+                        else:
+                            p.saveImage(fname, z, engine=self.tiles)
+                        continue
+                    with lock:
+                        pending[0] += 1
+                    job = None
+                    try:
+                        if self.raw_tiles:
+                            job = p.saveTiles(fname, z, self.tiles, wait=False, callback=finished)
+                        else:
+                            job = p.saveImageAsync(fname, z, self.tiles, callback=finished)
+                    finally:
+                        if job is None:
+                            finished()      # nothing queued
+            dzoom = 0
+            if self.depth:
+                fname = pbase + ('_depth.json' if self.depth_json else '_depth.bin')
+                if not (os.path.exists(fname) and self.skip):
+                    p.saveDepthData(fname)
+
+                fname = pbase+'_zoom_0_depth.jpg'
+                if not (os.path.exists(fname) and self.skip):
+                    p.saveDepthImage(fname, dzoom)
+        finally:
+            finished()
 
     def worker(self, id):
         loger.debug('Starting thread %d' % (id,))
@@ -154,24 +306,65 @@ class Crawler:
             if self.db.isSentinel(pano_id):
                 self.db.task_done()
                 break
+            handed = False
             try:
-                p = Panorama(pano_id)
-                self.savePano(p, self.zoom)
-                self.visitPano(p)
+                p = Panorama(pano_id, pool=self.pool)
+                pbase = self.discoverPano(p)
+                if pbase:
+                    handed = True               # done once its media is saved
+                    if self.n_media:
+                        self.media.put((p, pbase))  # blocks while the queue is full
+                    else:
+                        self.savePanoMedia(p, pbase, self.zoom,
+                                           done=lambda pano_id=pano_id: self.db.task_done(pano_id))
             except Exception as e:
                 msg = 'Thread %d - %s:%s' % (id, type(e).__name__, str(e))
                 loger.error(msg)
             finally:
-                self.db.task_done()
+                if not handed:
+                    self.db.task_done(pano_id)
 
         loger.debug('Exiting thread %d' % (id,))
 
+    def discoverPano(self, p):
+        """
+        Discovery stage, saves metadata and visits the panorama.
+        Media is saved by the caller, see savePanoMedia().
+        :param p: Panorama - object
+        :return: string - path prefix of panorama files, None if
+                 the panorama is not saved
+        """
+        pbase = self.panoBase(p)
+        if pbase:
+            self.savePanoMeta(p, pbase)
+        self.visitPano(p)
+        return pbase
+
+    def mediaWorker(self, id):
+        loger.debug('Starting media thread %d' % (id,))
+        while True:
+            item = self.media.get()
+            if item is None:
+                break
+            p, pbase = item
+            try:
+                self.savePanoMedia(p, pbase, self.zoom,
+                                   done=lambda pano_id=p.pano_id: self.db.task_done(pano_id))
+            except Exception as e:
+                msg = 'Media thread %d - %s:%s' % (id, type(e).__name__, str(e))
+                loger.error(msg)
+        loger.debug('Exiting media thread %d' % (id,))
+
     def startThreads(self):
         self.db.cleanSentinels()
         self.exit_flag = False
         for j in range(self.n_thr):
             self.threads[j] = threading.Thread(target=self.worker, args=(j,))
             self.threads[j].start()
+        self.media_threads = [threading.Thread(target=self.mediaWorker, args=(j,))
+                              for j in range(self.n_media)]
+        for t in self.media_threads:
+            t.start()
         loger.debug('Threads started')
 
     def stopThreads(self):
@@ -181,18 +374,38 @@ class Crawler:
 
         for t in self.threads:
             t.join()
+
+        # panoramas waiting for media are queued again, the ones
+        # being downloaded are finished
+        while self.n_media:
+            try:
+                p, pbase = self.media.get_nowait()
+            except Empty:
+                break
+            self.db.release(p.pano_id)
+        for _ in self.media_threads:
+            self.media.put(None)
+        for t in self.media_threads:
+            t.join()
         loger.debug('Threads stopped')
 
     def onexit(self):
         print 'Sopping threads and saving.... please wait.'
         loger.debug('Exiting')
         self.stopThreads()
-        self.save(self.fname)
+        self.tiles.join()               # images still in flight
+        self.save()
+        loger.info('Neighbours pruned before fetching: %d' % (self.n_pruned,))
+        if self.cache:
+            loger.info('Cache hits: %d, misses: %d' % (self.cache.hits, self.cache.misses))
+        mc = panorama.metaCache
+        loger.info('Metadata cache hits: %d, misses: %d' % (mc.hits, mc.misses))
         print 'Done'
 
     def run(self):
         """
-        Performs parallel BFS crawling. Main threads perform crawling via BFS.
+        Performs parallel BFS crawling. Main threads perform crawling via BFS,
+        or nearest-first in the nearest mode.
         There are two auxiliary threads. Former manages periodic database backup
         while latter periodically prints state of downloading. Saving the current
         state at KeyboardInterrupt is handled.
@@ -252,7 +465,54 @@ class Backuper:
             print 'Backed up!'
             self.tl = time.time()
 
+def testPruning():
+    """
+    Outward link of a panorama at the edge of a circle is pruned,
+    its metadata is never requested. Network is replaced by a fake
+    getMeta().
+    """
+    import shutil
+    import tempfile
+    ll0 = (50.0833, 14.4167)
+    edge = panorama.offsetLatlng(ll0, 0, 495)      # 5 m inside r = 500 m
+    def meta(ll, links):
+        return {'Location': {'lat': ll[0], 'lng': ll[1]},
+                'Data': {'copyright': 'Google', 'image_date': '2020-01'},
+                'Links': [{'panoId': n, 'yawDeg': yaw} for n, yaw in links]}
+    metas = {
+        'tEdge': meta(edge, [('tOut', 0), ('tIn', 180), ('tSide', 90)]),
+        'tIn': meta(panorama.offsetLatlng(edge, 180, 10), [('tEdge', 0)]),
+        'tSide': meta(panorama.offsetLatlng(edge, 90, 10), [('tEdge', 270)]),
+        'tOut': meta(panorama.offsetLatlng(edge, 0, 10), [('tEdge', 180)])
+    }
+    fetched = []
+    def getMeta(p):
+        fetched.append(p.pano_id)
+        return metas[p.pano_id]
+
+    panorama.metaCache.clear()
+    root = tempfile.mkdtemp()
+    getMeta0 = Panorama.getMeta
+    Panorama.getMeta = getMeta
+    try:
+        c = Crawler(pano_id='tEdge', validator=validator.circle(latlng_origin=ll0, radius=500),
+                    root=root, time=False, prune_slack=0)
+        while not c.db.qempty():
+            pano_id = c.db.dequeue()
+            c.visitPano(Panorama(pano_id, pool=c.pool))
+            c.db.task_done(pano_id)
+    finally:
+        Panorama.getMeta = getMeta0
+        shutil.rmtree(root)
+
+    if sorted(fetched) != ['tEdge', 'tIn', 'tSide'] or c.n_pruned != 1:
+        print 'FAILED', fetched, c.n_pruned
+    else:
+        print 'PASSED'
+
 if __name__ == '__main__':
+    testPruning()
+
     ll_Praha = (50.0833, 14.4167)
     ll_Berk = (37.8734834, -122.2593292)
     ll_Berk3 = (37.8734834, -122.2593292-0.01)
@@ -1,6 +1,15 @@
 import queue
 import pickle
 import logging
+import json
+import threading
+import os
+import sqlite3
+import heapq
+import itertools
+from collections import OrderedDict
+from collections import deque
+from compact import KeySet, VisitedRecords
 
 loger = logging.getLogger(__name__)
 loger.setLevel(logging.WARNING)
@@ -11,6 +20,17 @@ class Dbdata:
     s = set()
     active = 0
 
+def fsyncDir(fname):
+    """
+    Flushes directory entry of a renamed file to the disk.
+    :param fname: string - file in the directory
+    """
+    fd = os.open(os.path.dirname(os.path.abspath(fname)), os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
 '''
 When sentinel is found in the queue
 it terminates worker thread.
@@ -20,16 +40,43 @@ class Sentinel:
 
 
 class Database:
-    def __init__(self):
-        self.q = queue.Queue()
-        self.d = dict()
-        self.s = set()
+    """
+    In-memory crawl state. The frontier is FIFO (BFS) by default. In
+    priority mode it is a PriorityQueue of (priority, seq, key) items,
+    keys with the lowest priority (e.g. distance from the area origin)
+    are dequeued first, ties in the enqueue order.
+    """
+    def __init__(self, priority=False):
+        self.priority = priority
+        self.seq = itertools.count()
+        self.q = self._newQueue()
+        self.d = VisitedRecords()       # pano_id -> {'latlng', 'date'}
+        self.s = KeySet()               # seen pano ids, queued or visited
         self.active = 0
+        self.lock = threading.RLock()   # d and s, shared by crawling threads
+
+    def _newQueue(self):
+        return queue.PriorityQueue() if self.priority else queue.Queue()
+
+    def _item(self, key, priority=0):
+        # queue item of the key
+        if self.priority:
+            return (priority, next(self.seq), key)
+        return key
+
+    def _unpack(self, item):
+        # (key, priority) of a queue item
+        if isinstance(item, tuple):
+            return item[2], item[0]
+        return item, 0
 
     def prependSentinel(self):
         self.q.not_empty.acquire()
         try:
-            self.q.queue.appendleft(Sentinel())
+            if self.priority:
+                heapq.heappush(self.q.queue, self._item(Sentinel(), float('-inf')))
+            else:
+                self.q.queue.appendleft(Sentinel())
             self.q.unfinished_tasks += 1
             self.q.not_empty.notify()
         finally:
@@ -38,9 +85,13 @@ class Database:
     def cleanSentinels(self):
         self.q.not_full.acquire()
         try:
-            while(len(self.q.queue) > 0 and self.isSentinel(self.q.queue[0])):
+            while(len(self.q.queue) > 0 and
+                  self.isSentinel(self._unpack(self.q.queue[0])[0])):
                 # dead lock
-                self.q.queue.popleft()
+                if self.priority:
+                    heapq.heappop(self.q.queue)
+                else:
+                    self.q.queue.popleft()
                 self.q.unfinished_tasks -= 1
             self.q.not_full.notify()
         finally:
@@ -54,22 +105,49 @@ class Database:
 
         return False
 
-    def enqueue(self, key):
-        if key not in self.s:
-            self.s.add(key)
-            self.q.put(key)
+    def enqueue(self, key, priority=0):
+        """
+        :param key: string - pano id
+        :param priority: float - lower is dequeued sooner, ignored
+                         in FIFO mode
+        """
+        with self.lock:
+            if key not in self.s:
+                self.s.add(key)
+                self.q.put(self._item(key, priority))
 
     def dequeue(self):
         item = self.q.get()
         with self.q.mutex:
             self.active += 1
-        return item
+        return self._unpack(item)[0]
+
+    def release(self, key, priority=0):
+        """
+        Returns dequeued, not done key to the queue, e.g. of a lost
+        remote worker. The key is dequeued next, in priority mode
+        by its priority.
+        :param key: string - pano id
+        :param priority: float - priority of the key in priority mode
+        """
+        self.q.not_empty.acquire()
+        try:
+            if self.priority:
+                heapq.heappush(self.q.queue, self._item(key, priority))
+            else:
+                self.q.queue.appendleft(key)
+            self.active -= 1
+            self.q.not_empty.notify()
+        finally:
+            self.q.not_empty.release()
 
     def add(self, key, val):
-        self.d[key] = val
+        with self.lock:
+            self.d[key] = val
 
     def has(self, key):
-        return key in self.s
+        with self.lock:
+            return key in self.s
 
     def dsize(self):
         return len(self.d)
@@ -80,7 +158,7 @@ class Database:
     def qempty(self):
         return self.qsize() == 0
 
-    def task_done(self):
+    def task_done(self, key=None):
         with self.q.mutex:
             self.active -= 1
         self.q.task_done()
@@ -102,8 +180,16 @@ class Database:
         dbdata.active = self.active
         dbdata.qvec = self.q.queue
 
-        with open(fname, 'w') as f:
+        # Written aside and renamed in place, previous file is kept as .bck
+        tmp = fname + '.tmp'
+        with open(tmp, 'w') as f:
             pickle.dump(dbdata, f)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(fname):
+            os.rename(fname, fname + '.bck')
+        os.rename(tmp, fname)
+        fsyncDir(fname)
 
         if not self.active == 0:
             raise ValueError('Non-zero active thread counter.')
@@ -114,10 +200,498 @@ class Database:
 
         self.d = dbdata.d
         self.s = dbdata.s
+        if not isinstance(self.d, VisitedRecords):     # legacy dict and set
+            self.d = VisitedRecords(len(dbdata.d))
+            for key, val in dbdata.d.iteritems():
+                self.d[key] = val
+        if not isinstance(self.s, KeySet):
+            self.s = KeySet(len(dbdata.s))
+            for key in dbdata.s:
+                self.s.add(key)
         self.active = dbdata.active
-        self.q = queue.Queue()
+        self.q = self._newQueue()
         for item in dbdata.qvec:
-            self.q.put(item)
+            self.q.put(self._item(*self._unpack(item)))
+
+class JournalDatabase(Database):
+    """
+    Database persisted as a snapshot and an append-only journal of
+    events since the snapshot. Every change writes one JSON line:
+        ["e", key]          - key enqueued, ["e", key, priority]
+                              in priority mode
+        ["a", key, val]     - visited panorama added
+        ["d", key]          - key processed (task done)
+    Persistence costs O(new events). The snapshot is rewritten
+    (compaction) when the journal grows beyond the size of the state.
+    Recovery loads the snapshot and replays the journals, keys which
+    were dequeued but not done are queued again.
+
+    Files: <fname>.snapshot, <fname>.journal and <fname>.journal.old,
+    the last one exists only while a compaction is in progress.
+    """
+    compact_ratio = 1.0     # compact if No. of events > ratio * state size
+    compact_min = 10000     # ... and at least this many events
+
+    def __init__(self, fname, priority=False):
+        Database.__init__(self, priority)
+        self.fname_snapshot = fname + '.snapshot'
+        self.fname_journal = fname + '.journal'
+        self.fname_old = fname + '.journal.old'
+        self.inflight = {}          # dequeued, not done keys -> priority
+        self.n_events = 0           # events in journal since snapshot
+        self.f = None
+        self.compactor = None       # background snapshot thread
+
+    def exists(self):
+        """ True if there is a persisted state to resume. """
+        return os.path.exists(self.fname_snapshot) or \
+               os.path.exists(self.fname_journal) or \
+               os.path.exists(self.fname_old)
+
+    def open(self):
+        """
+        Recovers persisted state (if any) and opens the
+        journal for appending.
+        """
+        pending = OrderedDict()             # key -> priority
+        for item in sorted(self.q.queue) if self.priority else self.q.queue:
+            key, priority = self._unpack(item)  # e.g. loaded from pickle
+            if not self.isSentinel(key):
+                pending[key] = priority
+
+        self._replay(self.fname_snapshot, pending)
+        self._replay(self.fname_old, pending)
+        self._replay(self.fname_journal, pending)
+
+        self.q = self._newQueue()
+        for key, priority in pending.iteritems():
+            self.q.put(self._item(key, priority))
+        self.active = 0
+
+        self.f = open(self.fname_journal, 'a', 1)     # line buffered
+        if os.path.exists(self.fname_old):
+            self.compact()                  # finish interrupted compaction
+
+    def _replay(self, fname, pending):
+        if not os.path.exists(fname):
+            return
+        with open(fname) as f:
+            for line in f:
+                try:
+                    ev = json.loads(line)
+                except ValueError:
+                    loger.warning('Torn journal line skipped: %s' % (fname,))
+                    continue
+                op, key = ev[0], str(ev[1])
+                if op == 'e' or op == 'q':
+                    if key not in self.s:
+                        self.s.add(key)
+                        pending[key] = ev[2] if len(ev) > 2 else 0
+                elif op == 's':
+                    self.s.add(key)
+                elif op == 'd':
+                    pending.pop(key, None)
+                elif op == 'a':
+                    val = dict((str(k), tuple(v) if isinstance(v, list) else v)
+                               for k, v in ev[2].iteritems())
+                    self.d[key] = val
+                if op in 'ead':
+                    self.n_events += 1
+
+    def _log(self, ev):
+        self.f.write(json.dumps(ev) + '\n')
+        self.n_events += 1
+
+    def _record(self, op, key, priority):
+        # queue record, priority only in priority mode
+        return [op, key, priority] if self.priority else [op, key]
+
+    def enqueue(self, key, priority=0):
+        with self.lock:
+            if key not in self.s:
+                self.s.add(key)
+                self.q.put(self._item(key, priority))
+                self._log(self._record('e', key, priority))
+
+    def dequeue(self):
+        # Key moves from the queue to in-flight keys under the queue
+        # mutex, compaction never sees it in neither of them.
+        self.q.not_empty.acquire()
+        try:
+            while not self.q._qsize():
+                self.q.not_empty.wait()
+            key, priority = self._unpack(self.q._get())
+            self.q.not_full.notify()
+            self.active += 1
+            if not self.isSentinel(key):
+                self.inflight[key] = priority
+            return key
+        finally:
+            self.q.not_empty.release()
+
+    def release(self, key, priority=0):
+        # Not journaled, the key is not done, hence queued again on
+        # recovery anyway. Moved under the lock, compaction sees it
+        # either in flight or queued.
+        with self.lock:
+            priority = self.inflight.pop(key, priority)
+            Database.release(self, key, priority)
+
+    def add(self, key, val):
+        with self.lock:
+            self.d[key] = val
+            self._log(['a', key, val])
+
+    def task_done(self, key=None):
+        if key is not None and not self.isSentinel(key):
+            with self.lock:
+                self.inflight.pop(key, None)
+                self._log(['d', key])
+        Database.task_done(self)
+
+    def sync(self):
+        """ Flushes journal to the disk. """
+        with self.lock:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+
+    def checkpoint(self):
+        """
+        Makes the journal durable and starts a background compaction
+        if the journal grew too large compared to the state. Workers
+        keep running, see compact().
+        """
+        self.sync()
+        if self.compactor and self.compactor.is_alive():
+            return                          # previous one still writing
+        state = len(self.s) + len(self.d)
+        if self.n_events > max(self.compact_min, self.compact_ratio * state):
+            self.compact(wait=False)
+
+    def compact(self, wait=True):
+        """
+        Writes current state as a new snapshot and drops the journal.
+        A consistent copy of the state is taken and the journal is
+        rotated under a short lock, the snapshot is written afterwards
+        while workers keep journaling into the new journal. The old
+        journal is removed only when the new snapshot is fsynced and
+        renamed in place, hence a crash at any point is recoverable.
+        :param wait: bool - write the snapshot in a background thread
+                     if False
+        """
+        if self.compactor:
+            self.compactor.join()           # one compaction at a time
+            self.compactor = None
+
+        with self.lock:
+            self.f.close()
+            if not os.path.exists(self.fname_old):
+                os.rename(self.fname_journal, self.fname_old)
+            else:                           # unfinished compaction
+                self._append(self.fname_journal, self.fname_old)
+            self.f = open(self.fname_journal, 'a', 1)
+            self.n_events = 0
+
+            with self.q.mutex:
+                queued = list(self.q.queue)
+                inflight = self.inflight.items()
+            seen = self.s.copy()
+            visited = self.d.copy()
+
+        args = (queued, inflight, seen, visited)
+        if wait:
+            self._writeSnapshot(*args)
+        else:
+            self.compactor = threading.Thread(target=self._writeSnapshot, args=args)
+            self.compactor.start()
+
+    def _writeSnapshot(self, queued, inflight, seen, visited):
+        if self.priority:
+            queued.sort()                   # heap into dequeue order
+        queued = [self._unpack(item) for item in queued]
+        queued = [(k, p) for k, p in queued if not self.isSentinel(k)]
+        pending = set(k for k, _ in queued) | set(k for k, _ in inflight)
+        tmp = self.fname_snapshot + '.tmp'
+        with open(tmp, 'w') as f:
+            for key, priority in inflight:
+                f.write(json.dumps(self._record('q', key, priority)) + '\n')
+            for key, priority in queued:
+                f.write(json.dumps(self._record('q', key, priority)) + '\n')
+            for key in seen:
+                if key not in pending:
+                    f.write(json.dumps(['s', key]) + '\n')
+            for key, val in visited.iteritems():
+                f.write(json.dumps(['a', key, val]) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp, self.fname_snapshot)
+        fsyncDir(self.fname_snapshot)
+        os.remove(self.fname_old)
+        loger.info('Snapshot written: %s' % (self.fname_snapshot,))
+
+    def _append(self, src, dst):
+        with open(src) as fi, open(dst, 'a') as fo:
+            for line in fi:
+                fo.write(line)
+        os.remove(src)
+
+    def close(self):
+        """ Compacts the state and closes the journal. """
+        self.compact()
+        self.f.close()
+
+    def save(self, fname=None):
+        """
+        Persists current state as a snapshot, fname is ignored,
+        see compact().
+        """
+        self.compact()
+
+    def load(self, fname):
+        """
+        Imports legacy pickled Database, see Database.save(). The
+        journal must be open, the imported state is compacted.
+        """
+        Database.load(self, fname)
+        self.active = 0
+        self.compact()
+
+
+class SqliteDatabase(Database):
+    """
+    Database kept in SQLite in WAL mode, memory stays flat as the
+    crawl grows and the state can be inspected while crawling.
+    Tables:
+        frontier(seq, pano_id, state, priority)
+                                        - every seen key in enqueue
+                                          order, state 0 queued,
+                                          1 in flight, 2 done
+        visited(pano_id, lat, lng, year, month)
+    Writes are buffered and committed in batched transactions. Keys
+    are leased from the frontier in chunks. Keys in flight when the
+    crawl was interrupted are queued again on open(). In priority
+    mode keys are leased by the lowest priority, the order is exact
+    up to the prefetched chunk.
+    """
+    batch = 1000            # buffered writes per transaction
+    prefetch = 256          # keys leased from the frontier at once
+
+    schema = [
+        '''CREATE TABLE IF NOT EXISTS frontier (
+               seq INTEGER PRIMARY KEY AUTOINCREMENT,
+               pano_id TEXT NOT NULL UNIQUE,
+               state INTEGER NOT NULL DEFAULT 0,
+               priority REAL NOT NULL DEFAULT 0)''',
+        '''CREATE INDEX IF NOT EXISTS frontier_state ON frontier (state, seq)''',
+        '''CREATE TABLE IF NOT EXISTS visited (
+               pano_id TEXT PRIMARY KEY,
+               lat REAL, lng REAL, year INTEGER, month INTEGER)''',
+        '''CREATE INDEX IF NOT EXISTS visited_latlng ON visited (lat, lng)''',
+        '''CREATE INDEX IF NOT EXISTS visited_date ON visited (year, month)'''
+    ]
+
+    def __init__(self, fname, priority=False):
+        self.fname = fname
+        self.priority = priority
+        self.conn = None
+        self.lock = threading.RLock()
+        self.cond = threading.Condition(self.lock)
+        self.head = deque()         # keys leased from the frontier
+        self.sentinels = 0
+        self.new = OrderedDict()    # buffered writes, new key -> priority
+        self.done = []
+        self.added = []
+        self.n_queued = 0           # keys with state 0 in the table
+        self.n_visited = 0
+        self.unfinished = 0
+        self.active = 0
+
+    def exists(self):
+        """ True if there is a persisted state to resume. """
+        return os.path.exists(self.fname)
+
+    def open(self):
+        self.conn = sqlite3.connect(self.fname, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        for sql in self.schema:
+            self.conn.execute(sql)
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(frontier)')]
+        if 'priority' not in columns:       # db of an older version
+            self.conn.execute('ALTER TABLE frontier ADD COLUMN priority REAL NOT NULL DEFAULT 0')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS frontier_priority '
+                          'ON frontier (state, priority, seq)')
+        # Keys in flight of an interrupted crawl are queued again
+        self.conn.execute('UPDATE frontier SET state=0 WHERE state=1')
+        self.conn.commit()
+
+        cur = self.conn.execute('SELECT COUNT(*) FROM frontier WHERE state=0')
+        self.n_queued = cur.fetchone()[0]
+        cur = self.conn.execute('SELECT COUNT(*) FROM visited')
+        self.n_visited = cur.fetchone()[0]
+        self.unfinished = self.n_queued
+
+    def _flush(self):
+        if not (self.new or self.done or self.added):
+            return
+        with self.conn:                     # one transaction
+            self.conn.executemany(
+                'INSERT OR IGNORE INTO frontier (pano_id, priority) VALUES (?, ?)',
+                self.new.iteritems())
+            self.conn.executemany(
+                'UPDATE frontier SET state=2 WHERE pano_id=?',
+                ((key,) for key in self.done))
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO visited VALUES (?, ?, ?, ?, ?)',
+                self.added)
+        self.n_queued += len(self.new)
+        self.new = OrderedDict()
+        self.done = []
+        self.added = []
+
+    def _maybeFlush(self):
+        if len(self.new) + len(self.done) + len(self.added) >= self.batch:
+            self._flush()
+
+    def _lease(self):
+        order = 'priority, seq' if self.priority else 'seq'
+        cur = self.conn.execute(
+            'SELECT pano_id FROM frontier WHERE state=0 ORDER BY %s LIMIT ?' % (order,),
+            (self.prefetch,))
+        keys = [str(row[0]) for row in cur]
+        with self.conn:
+            self.conn.executemany('UPDATE frontier SET state=1 WHERE pano_id=?',
+                                  ((key,) for key in keys))
+        self.n_queued -= len(keys)
+        self.head.extend(keys)
+
+    def _has(self, key):
+        if key in self.new:
+            return True
+        cur = self.conn.execute('SELECT 1 FROM frontier WHERE pano_id=?', (key,))
+        return cur.fetchone() is not None
+
+    def prependSentinel(self):
+        with self.cond:
+            self.sentinels += 1
+            self.unfinished += 1
+            self.cond.notify()
+
+    def cleanSentinels(self):
+        with self.cond:
+            self.unfinished -= self.sentinels
+            self.sentinels = 0
+
+    def enqueue(self, key, priority=0):
+        with self.cond:
+            if self._has(key):
+                return
+            self.new[key] = priority
+            self.unfinished += 1
+            self._maybeFlush()
+            self.cond.notify()
+
+    def dequeue(self):
+        with self.cond:
+            while True:
+                if self.sentinels:
+                    self.sentinels -= 1
+                    self.active += 1
+                    return Sentinel()
+                if not self.head and (self.n_queued or self.new):
+                    self._flush()           # buffered keys are queued last
+                    self._lease()
+                    if not self.head:
+                        self.n_queued = 0   # nothing left in the table
+                if self.head:
+                    self.active += 1
+                    return self.head.popleft()
+                self.cond.wait()
+
+    def release(self, key, priority=0):
+        # The key stays leased (state 1) in the table, queued again
+        # on open() if the crawl is interrupted.
+        with self.cond:
+            self.head.appendleft(key)
+            self.active -= 1
+            self.cond.notify()
+
+    def add(self, key, val):
+        lat, lng = val['latlng']
+        year, month = val['date']
+        with self.lock:
+            self.added.append((key, lat, lng, year, month))
+            self.n_visited += 1
+            self._maybeFlush()
+
+    def has(self, key):
+        with self.lock:
+            return self._has(key)
+
+    def dsize(self):
+        return self.n_visited
+
+    def qsize(self):
+        return self.unfinished - self.active
+
+    def task_done(self, key=None):
+        with self.cond:
+            if key is not None and not self.isSentinel(key):
+                self.done.append(key)
+                self._maybeFlush()
+            self.active -= 1
+            self.unfinished -= 1
+            if self.unfinished <= 0:
+                if self.unfinished < 0:
+                    raise ValueError('task_done() called too many times')
+                self.cond.notify_all()
+
+    def isCompleted(self):
+        return self.unfinished == 0
+
+    def join(self):
+        with self.cond:
+            while self.unfinished:
+                self.cond.wait()
+
+    def checkpoint(self):
+        """ Commits buffered writes and checkpoints the WAL. """
+        with self.lock:
+            self._flush()
+            self.conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def save(self, fname=None):
+        """ Commits buffered writes, fname is ignored. """
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.conn.close()
+
+    def load(self, fname):
+        """
+        Imports legacy pickled Database, see Database.save().
+        The database must be open.
+        """
+        db = Database()
+        db.load(fname)
+        with self.cond:
+            for item in db.q.queue:
+                key, priority = db._unpack(item)
+                if not self.isSentinel(key) and not self._has(key):
+                    self.new[key] = priority
+                    self.unfinished += 1
+            self._flush()
+            with self.conn:
+                self.conn.executemany(
+                    'INSERT OR IGNORE INTO frontier (pano_id, state) VALUES (?, 2)',
+                    ((key,) for key in db.s))
+            for key, val in db.d.iteritems():
+                self.add(key, val)
+            self._flush()
+            self.cond.notify_all()
 
 def test1():
     db = Database()
@@ -0,0 +1,131 @@
+from struct import Struct
+import threading
+import numpy as np
+
+# Unit rays from the camera center, cached per depth map size
+_rays = {}
+_lock = threading.Lock()
+
+def rays(width, height):
+    """
+    Unit ray directions of a spherical depth map. The grid depends
+    only on the size, it is computed once and shared.
+    :param width: int - depth map width
+    :param height: int - depth map height
+    :return: numpy.ndarray - h x w x 3 float32, read-only
+    """
+    key = (width, height)
+    v = _rays.get(key)
+    if v is not None:
+        return v
+
+    w, h = width, height
+    pi = np.pi
+
+    # Rays from camera center in spherical coordinates
+    y, x = np.indices((h, w))           # grid of coordinates
+    offset = pi/2                       # no idea why not pi,
+    yaw = (w-1 - x) * 2*pi / (w-1) + offset
+    pitch = (h-1 - y) * pi / (h-1)      # 0 down, pi/2 horizontal, pi up
+
+    # Rays from spherical to cartesian
+    v = np.array([
+        np.sin(pitch) * np.cos(yaw),
+        np.sin(pitch) * np.sin(yaw),
+        np.cos(pitch)
+    ], np.float32)
+    v = np.ascontiguousarray(v.transpose(1, 2, 0))
+    v.setflags(write=False)
+
+    with _lock:
+        return _rays.setdefault(key, v)
+
+def depthMap(size, lbls, planes):
+    """
+    Distance from the camera center for every pixel of the depth
+    map, i.e. intersection of the pixel ray with its plane d/|v.n|.
+    :param size: tuple (width w, height h)
+    :param lbls: numpy.ndarray - h x w plane labels
+    :param planes: numpy.ndarray - n_planes x 4, rows (n_0, n_1, n_2, d)
+    :return: numpy.ndarray - h x w float32, NaN where there is no plane
+    """
+    w, h = size
+    v = rays(w, h)
+
+    # w x h x 4 plane per pixel: normal and distance
+    p = np.take(planes, lbls, axis=0)
+    d = p[..., 3]
+    d[d == 0] = np.nan
+
+    # distance from camera centetr, ray inersection with plane
+    return d / np.abs(np.einsum('ijk,ijk->ij', v, p[..., :3]))
+
+def depthMaps(depthdata):
+    """
+    Depth maps of many panoramas in one call, see depthMap().
+    All panoramas of the same size share one cached ray grid.
+    :param depthdata: list of tuples (size, lbls, planes) as returned by
+                      Panorama.getDepthData(), -1 or None items allowed
+    :return: list of numpy.ndarray - h x w float32, None for missing data
+    """
+    out = []
+    for dd in depthdata:
+        if dd is None or isinstance(dd, int):
+            out.append(None)
+        else:
+            out.append(depthMap(*dd))
+    return out
+
+
+# Binary depth file: header, h x w uint8 labels, n_planes x 4 float32
+# planes. Planes start at 4-byte aligned offset, both arrays are
+# little endian and can be memory-mapped.
+_magic = 'SGDM'
+_version = 1
+_header = Struct('< 4s B x 3H')        # magic, version, n_planes, width, height
+
+def _planesOffset(width, height):
+    n = _header.size + width*height
+    return n + (-n % 4)
+
+def save(fname, depthdata):
+    """
+    Saves depth data in the compact binary format.
+    :param fname: string - filename
+    :param depthdata: tuple (size, lbls, planes) - see
+                      Panorama.getDepthData()
+    """
+    (w, h), lbls, planes = depthdata
+    lbls = np.ascontiguousarray(lbls, np.uint8)
+    planes = np.ascontiguousarray(planes, np.dtype('<f4'))
+    n_planes = len(planes)
+
+    with open(fname, 'wb') as f:
+        f.write(_header.pack(_magic, _version, n_planes, w, h))
+        f.write(lbls.tostring())
+        f.write('\0' * (_planesOffset(w, h) - _header.size - w*h))
+        f.write(planes.tostring())
+
+def load(fname, mmap=True):
+    """
+    Loads depth data saved by save(). The arrays are memory-mapped
+    by default, nothing is parsed.
+    :param fname: string - filename
+    :param mmap: bool - memory-map arrays instead of reading them
+    :return: tuple ((width w, height h), labels, planes)
+    """
+    with open(fname, 'rb') as f:
+        magic, version, n_planes, w, h = _header.unpack(f.read(_header.size))
+        if magic != _magic or version != _version:
+            raise ValueError('Not a depth file: %s' % (fname,))
+
+        offset = _planesOffset(w, h)
+        if not mmap:
+            lbls = np.fromfile(f, np.uint8, w*h).reshape((h, w))
+            f.seek(offset)
+            planes = np.fromfile(f, np.dtype('<f4'), 4*n_planes)
+            return (w, h), lbls, planes.reshape((n_planes, 4))
+
+    lbls = np.memmap(fname, np.uint8, 'r', _header.size, (h, w))
+    planes = np.memmap(fname, np.dtype('<f4'), 'r', offset, (n_planes, 4))
+    return (w, h), lbls, planes
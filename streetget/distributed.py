@@ -0,0 +1,375 @@
+"""
+Crawling on several machines. The coordinator owns the database,
+i.e. frontier, seen pano ids and visited records, and serves it over
+TCP. Workers lease batches of pano ids, fetch and save panoramas
+locally and report visited records and neighbours back.
+
+Protocol is one JSON object per line, every request gets one reply:
+    {"op": "config"}            -> {"config": {...}} crawl arguments
+    {"op": "lease", "n": N}     -> {"lease": ID, "keys": [...], "ttl": T}
+                                   {"wait": T} frontier empty for now
+                                   {"done": true} crawl completed
+    {"op": "report", "lease": ID, "pano_id": K,
+     "record": {...} or null, "neighbours": [[K, priority], ...]}
+                                -> {"ok": false} if the lease expired
+    {"op": "release", "lease": ID}
+                                -> {"ok": true} keys left unvisited
+Every report extends the lease by ttl seconds. Keys of expired leases,
+released leases and leases of closed connections are queued again and
+leased to other workers.
+"""
+from panorama import Panorama
+from crawler import Crawler
+import SocketServer
+import itertools
+import threading
+import logging
+import socket
+import json
+import time
+
+loger = logging.getLogger('distributed')
+loger.setLevel(logging.DEBUG)
+
+
+def send(f, msg):
+    f.write(json.dumps(msg) + '\n')
+    f.flush()
+
+def recv(f):
+    line = f.readline()
+    if not line:
+        raise socket.error('Connection closed')
+    return json.loads(line)
+
+
+class Lease:
+    def __init__(self, keys, ttl):
+        self.keys = list(keys)          # not reported yet
+        self.ttl = ttl
+        self.renew()
+
+    def renew(self):
+        self.deadline = time.time() + self.ttl
+
+    def expired(self, t):
+        return t > self.deadline
+
+
+class Handler(SocketServer.StreamRequestHandler):
+    """ Connection of one worker thread. """
+    def handle(self):
+        coord = self.server.coordinator
+        leases = set()
+        try:
+            while True:
+                try:
+                    req = recv(self.rfile)
+                except socket.error:
+                    break
+                rep = coord.handle(req)
+                if 'lease' in rep:
+                    leases.add(rep['lease'])
+                send(self.wfile, rep)
+        except Exception as e:
+            msg = 'Connection %s - %s:%s' % (self.client_address, type(e).__name__, str(e))
+            loger.error(msg)
+        finally:
+            for id in leases:
+                coord.release(id)       # worker gone, no need to wait for ttl
+
+
+class Server(SocketServer.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class Coordinator(Crawler):
+    """
+    Crawler serving its database to remote workers instead of
+    crawling itself, see Worker. Progress, periodic backup and
+    saving on exit are the same as of Crawler.run().
+    """
+    lease_ttl = 120                 # [s] lease lifetime without a report
+    poll = 1                        # [s] workers wait on an empty frontier
+
+    def __init__(self, port, host='127.0.0.1', config=None, **kwargs):
+        """
+        :param port: int - TCP port
+        :param host: string - interface, default loopback only,
+                     '' for all, the protocol is not authenticated
+        :param config: dictionary - crawl arguments for workers,
+                       JSON serializable
+        :param kwargs: see Crawler
+        """
+        Crawler.__init__(self, **kwargs)
+        self.addr = (host, port)
+        self.config = config or {}
+        self.lock = threading.RLock()
+        self.leases = {}            # id -> Lease
+        self.lease_ids = itertools.count(1)
+        self.n_expired = 0
+        self.stopping = False
+        self.server = None
+        self.threads = []
+
+    def handle(self, req):
+        op = req.get('op')
+        if op == 'lease':
+            return self.lease(int(req.get('n', 1)))
+        if op == 'report':
+            ok = self.report(req['lease'], str(req['pano_id']),
+                             req.get('record'), req.get('neighbours', []))
+            return {'ok': ok}
+        if op == 'release':
+            self.release(req['lease'])
+            return {'ok': True}
+        if op == 'config':
+            return {'config': self.config}
+        return {'error': 'Unknown op: %s' % (op,)}
+
+    def lease(self, n):
+        """
+        :param n: int - max. No. of keys
+        :return: dictionary - reply, see module doc
+        """
+        with self.lock:
+            if self.stopping:
+                return {'done': True}
+            keys = []
+            while len(keys) < n and not self.db.qempty():
+                keys.append(self.db.dequeue())
+            if keys:
+                id = next(self.lease_ids)
+                self.leases[id] = Lease(keys, self.lease_ttl)
+                return {'lease': id, 'keys': keys, 'ttl': self.lease_ttl}
+            if self.db.isCompleted():
+                return {'done': True}
+            return {'wait': self.poll}
+
+    def report(self, id, pano_id, record, neighbours):
+        """
+        Applies result of a visited panorama. Results of expired
+        leases are applied too, the key itself is left to its
+        new lease.
+        :return: bool - False if the lease is no longer held
+        """
+        with self.lock:
+            for n, prio in neighbours:
+                self.db.enqueue(str(n), float(prio))
+            if record:
+                data = {'latlng': tuple(record['latlng']), 'date': tuple(record['date'])}
+                self.db.add(pano_id, data)
+
+            lease = self.leases.get(id)
+            if lease is None or pano_id not in lease.keys:
+                return False
+            lease.keys.remove(pano_id)
+            lease.renew()
+            if not lease.keys:
+                del self.leases[id]
+            self.db.task_done(pano_id)
+            return True
+
+    def release(self, id):
+        """ Queues again keys of the lease not reported yet. """
+        with self.lock:
+            lease = self.leases.pop(id, None)
+            if lease is None:
+                return
+            for key in lease.keys:
+                self.db.release(key)
+
+    def reap(self):
+        # releases expired leases, e.g. of a dead worker machine
+        while not self.stopping:
+            time.sleep(self.poll)
+            t = time.time()
+            with self.lock:
+                expired = [id for id, lease in self.leases.items() if lease.expired(t)]
+                for id in expired:
+                    loger.warning('Lease %d expired, %d keys queued again' %
+                                  (id, len(self.leases[id].keys)))
+                    self.release(id)
+                self.n_expired += len(expired)
+
+    def startThreads(self):
+        self.stopping = False
+        self.server = Server(self.addr, Handler)
+        self.server.coordinator = self
+        self.threads = [threading.Thread(target=self.server.serve_forever),
+                        threading.Thread(target=self.reap)]
+        for t in self.threads:
+            t.start()
+        loger.info('Coordinator listening at %s:%d' % self.server.server_address)
+
+    def stopThreads(self):
+        """
+        Workers get done replies, keys of pending leases are queued
+        again before the database is saved.
+        """
+        loger.debug('Stopping coordinator...')
+        with self.lock:
+            self.stopping = True
+            for id in self.leases.keys():
+                self.release(id)
+        self.server.shutdown()
+        for t in self.threads:
+            t.join()
+        self.server.server_close()
+        loger.info('Leases expired: %d' % (self.n_expired,))
+        loger.debug('Coordinator stopped')
+
+
+class Connection:
+    """ Worker side of the protocol, see module doc. """
+    def __init__(self, addr, timeout=60):
+        """
+        :param addr: tuple (host, port) of the coordinator
+        :param timeout: float - socket timeout in seconds
+        """
+        self.sock = socket.create_connection(addr, timeout)
+        self.rfile = self.sock.makefile('rb')
+        self.wfile = self.sock.makefile('wb')
+
+    def call(self, **req):
+        """
+        :return: dictionary - reply
+        """
+        send(self.wfile, req)
+        return recv(self.rfile)
+
+    def close(self):
+        for f in (self.rfile, self.wfile):
+            try:
+                f.close()
+            except socket.error:
+                pass
+        self.sock.close()
+
+
+def fetchConfig(host, port):
+    """
+    :return: dictionary - crawl arguments served by the coordinator
+    """
+    conn = Connection((host, port))
+    try:
+        return conn.call(op='config')['config']
+    finally:
+        conn.close()
+
+
+class Worker(Crawler):
+    """
+    Crawler without database, pano ids are leased from a Coordinator.
+    Panoramas are saved into the local data directory. Every thread
+    has its own connection and lease. Worker exits when the crawl is
+    completed or the coordinator is unreachable for max_trials
+    attempts.
+    """
+    lease_size = 8                  # keys per lease
+    max_trials = 10
+    reconnect = 5                   # [s] wait between connection attempts
+
+    def __init__(self, host, port, **kwargs):
+        """
+        :param host: string - coordinator host
+        :param port: int - coordinator port
+        :param kwargs: see Crawler, backend is ignored
+        """
+        kwargs['backend'] = None
+        Crawler.__init__(self, **kwargs)
+        self.addr = (host, port)
+        self.n_visited = 0
+
+    def worker(self, id):
+        loger.debug('Starting thread %d' % (id,))
+        conn = None
+        trials = 0
+        while not self.exit_flag:
+            try:
+                if conn is None:
+                    conn = Connection(self.addr)
+                rep = conn.call(op='lease', n=self.lease_size)
+                trials = 0
+                if rep.get('done'):
+                    break
+                if 'wait' in rep:
+                    time.sleep(rep['wait'])
+                    continue
+                self.visitLease(id, conn, rep['lease'], rep['keys'])
+            except (socket.error, ValueError) as e:
+                trials += 1
+                msg = 'Thread %d - %s:%s' % (id, type(e).__name__, str(e))
+                loger.error(msg)
+                if conn:
+                    conn.close()
+                    conn = None
+                if trials >= self.max_trials:
+                    break
+                time.sleep(self.reconnect)
+        if conn:
+            conn.close()
+        loger.debug('Exiting thread %d' % (id,))
+
+    def visitLease(self, id, conn, lease, keys):
+        for pano_id in keys:
+            if self.exit_flag:
+                conn.call(op='release', lease=lease)
+                return
+            pano_id = str(pano_id)
+            data, neighbours = None, []
+            try:
+                p = Panorama(pano_id, pool=self.pool)
+                pbase = self.panoBase(p)
+                if pbase:
+                    self.savePanoMeta(p, pbase)
+                data, neighbours = self.discover(p)
+                if pbase:
+                    # reported once its media is saved, also in async mode
+                    saved = threading.Event()
+                    self.savePanoMedia(p, pbase, self.zoom, done=saved.set)
+                    saved.wait()
+            except Exception as e:
+                msg = 'Thread %d - %s:%s' % (id, type(e).__name__, str(e))
+                loger.error(msg)
+            rep = conn.call(op='report', lease=lease, pano_id=pano_id,
+                            record=data, neighbours=neighbours)
+            self.n_visited += 1
+            if not rep.get('ok'):
+                loger.warning('Thread %d - lease %d expired' % (id, lease))
+                return                  # rest is leased to others
+
+    def startThreads(self):
+        self.exit_flag = False
+        for j in range(self.n_thr):
+            self.threads[j] = threading.Thread(target=self.worker, args=(j,))
+            self.threads[j].start()
+        loger.debug('Threads started')
+
+    def stopThreads(self):
+        loger.debug('Stopping threads...')
+        self.exit_flag = True
+        for t in self.threads:
+            t.join()
+        loger.debug('Threads stopped')
+
+    def save(self):
+        pass                            # state is kept by the coordinator
+
+    def run(self):
+        """
+        Crawls until the coordinator reports the crawl completed.
+        Panoramas in progress are finished at KeyboardInterrupt,
+        the rest of their leases is released.
+        """
+        self.startThreads()
+        try:
+            while any(t.is_alive() for t in self.threads):
+                print 'Visited: %06d' % (self.n_visited,)
+                time.sleep(5)
+            print 'All panorama collected'
+        except (KeyboardInterrupt, SystemExit):
+            loger.debug('*** handling keyboard or system interrupt')
+        finally:
+            self.onexit()
@@ -1,26 +1,27 @@
-from queue import Queue
 from io import BytesIO
 from io import StringIO
 from itertools import product
 from urllib import urlencode
 from struct import Struct
-import threading
 import json
 import re
-import requests
 import sys, os
 import logging
+import math
+import time
 import numpy as np
 from PIL import Image
 from numpy import array
 from street_exceptions import NoSpatialNeighbours, NoTemporalNeighbours
 from street_exceptions import NoCollectLinks, CustomPanoramaNotSupported
 from street_exceptions import GoogleUpdating
-import matplotlib as mpl
-mpl.use('Agg')                  # avoid Tk window
-import matplotlib.pyplot as plt
-# NOTE: Tkinter a has problem with multithread. Matplotlib directive use('Agg')
-# turns on non-interactive backend and avoids displaying Tk window.
+import session
+import tiles
+from tiles import TileEngine
+from colormap import colorize
+import depth
+import sparse
+from cache import MemoryCache
 
 # Headers for URL GET requests, can be used in the future to fool google servers:
 headers = {
@@ -40,29 +41,74 @@ else:
     loger = logging.getLogger('panorama')
     loger.setLevel(logging.WARNING)
 
-class Panorama:
+# Metadata not fetched yet
+_unset = object()
+
+# Parsed metadata by pano id shared by all Panorama instances, the
+# same panorama is often constructed several times (validator origin,
+# crawler start, info). See metaCache.hits and metaCache.misses.
+metaCache = MemoryCache(256)
+
+class Panorama(object):
+    """
+    Street-view panorama. Metadata and timemachine metadata are
+    fetched lazily, on the first access of meta or time_meta.
+    """
     pano_id = None
-    meta = None
-    time_meta = None
     depthdata = None
     depthmap = None
+    pool = None
+    _meta = _unset
+    _time_meta = _unset
 
-    def __init__(self, pano_id=None, latlng=None, radius=15):
+    def __init__(self, pano_id=None, latlng=None, radius=15, pool=None):
+        self.pool = pool                # None - process-wide SessionPool
         if not pano_id and not latlng:
             return;
 
         self.pano_id = pano_id if pano_id else self.getPanoID(latlng, radius)
-        if not self.pano_id:    #pano_id not found
-            return
 
-        self.meta = self.getMeta()
-        self.time_meta = self.getTimeMeta()
+    @property
+    def meta(self):
+        """
+        Metadata, see getMeta(). Fetched on the first access
+        unless found in metaCache.
+        """
+        if self._meta is _unset:
+            meta = metaCache.get(self.pano_id) if self.pano_id else None
+            if meta is None:
+                meta = self.getMeta()
+                if self.pano_id and meta:
+                    metaCache.put(self.pano_id, meta)
+            self._meta = meta
+        return self._meta
+
+    @meta.setter
+    def meta(self, meta):
+        self._meta = meta
+
+    @property
+    def time_meta(self):
+        """ Timemachine metadata, see getTimeMeta(). Fetched on the first access. """
+        if self._time_meta is _unset:
+            self._time_meta = self.getTimeMeta()
+        return self._time_meta
+
+    @time_meta.setter
+    def time_meta(self, time_meta):
+        self._time_meta = time_meta
 
     def _pano_msg(self):
         '''
-        Serves for basic message in logger messages.
+        Serves for basic message in logger messages. Metadata
+        are not fetched, it is called while fetching them.
         '''
-        return '%s %.6f %.6f\n' % (self.pano_id, self.getGPS()[0], self.getGPS()[1])
+        lat = lng = None
+        if self._meta is not _unset and self._meta:
+            lat, lng = self.getGPS()
+        if lat is None or lng is None:
+            return '%s\n' % (self.pano_id,)
+        return '%s %.6f %.6f\n' % (self.pano_id, lat, lng)
 
     def getPanoID(self, latlng, radius=15):
         """
@@ -84,7 +130,7 @@ class Panorama:
             'radius':       radius,
         }
 
-        msg = self.requestData(url, query, headers)
+        msg = self.requestData(url, query, headers, kind='panoid')
         data = json.loads(msg)
         if len(data) is 0:
             return None
@@ -118,23 +164,49 @@ class Panorama:
         links of adjacent panoramas.
         :return: list - strings of adjacent panoId hashes
         """
-        pano_ids = []
+        return [pano_id for pano_id, yaw in self.getSpatialLinks()]
+
+    def getSpatialLinks(self):
+        """
+        Links of adjacent panoramas with their heading.
+        :return: list of tuples (pano_id, yaw) - yaw in degrees
+                 clockwise from north, None if not given
+        """
+        links = []
         try:
-            pano_ids = self._collectSpatialLinks()
+            links = self._collectSpatialLinks()
         except NoSpatialNeighbours:
             loger.warning(self._pano_msg() + 'Spatial neighbours not found.')
         except Exception:
-            loger.exception()
-        return pano_ids
+            loger.exception(self._pano_msg())
+        return links
 
     def _collectSpatialLinks(self):
         try:
-            pano_ids = []
+            links = []
             for x in self.meta['Links']:
-                pano_ids.append(x['panoId'])
+                yaw = x.get('yawDeg')
+                links.append((x['panoId'], float(yaw) if yaw is not None else None))
         except:
             raise NoSpatialNeighbours
-        return pano_ids
+        return links
+
+    def getNeighbourLocations(self, temporal=True, step=10):
+        """
+        Neighbour panoramas with their estimated positions, no
+        request is made. Links carry only a heading, spatial
+        neighbours are assumed 'step' meters away in the link
+        direction. Temporal neighbours are at the same place.
+        :param temporal: boolean - include temporal neighbours
+        :param step: float - assumed distance of spatial neighbours in meters
+        :return: list of tuples (pano_id, (lat, lng))
+        """
+        ll = self.getGPS()
+        out = [(pano_id, offsetLatlng(ll, yaw, step))
+               for pano_id, yaw in self.getSpatialLinks()]
+        if temporal:
+            out += [(pano_id, ll) for pano_id, t in self.getTemporalNeighbours() or []]
+        return out
 
     def getTemporalNeighbours(self):
         """
@@ -253,16 +325,58 @@ class Panorama:
         else:
             return [x for x,t in tn]            # temporal neighbours only
 
-    def getImage(self, zoom=5, n_threads=16):
+    def getImage(self, zoom=5, n_threads=16, engine=None):
         """
         Gets panorama image at given zoom level. The image
         consists of image tiles that are fetched and stitched
         together. The resulting image is cropped in order to
         form a spherical panorama.
         :param zoom:
-        :param n_threads:
+        :param n_threads: int - No. of threads of a temporary TileEngine
+                          used when no engine is given
+        :param engine: TileEngine - long-lived engine shared by callers
         :return: Image - panorama at given zoom level
         """
+        if engine:
+            job = self.getImageAsync(zoom, engine)
+            return job.result() if job else None
+
+        tw, th = self.numTiles(zoom)
+        engine = TileEngine(min(n_threads, tw*th))
+        try:
+            job = self.getImageAsync(zoom, engine)
+            return job.result() if job else None
+        finally:
+            engine.shutdown()
+
+    def getImageAsync(self, zoom=5, engine=None, callback=None):
+        """
+        Queues tiles of the panorama image at given zoom level
+        in a shared TileEngine and returns immediately. Tiles of
+        many panoramas are fetched by the same engine threads.
+        :param zoom: int [0-5] - zoom level
+        :param engine: TileEngine, default process-wide engine
+        :param callback: function(job) - called when all tiles arrive
+        :return: TileJob - job.result() gives the Image, None if
+                 the zoom level is not available
+        """
+        if self.isCustom():
+            raise NotImplementedError('Custom panorama is not implemented')
+
+        if not self.hasZoom(zoom):
+            print 'Panorama %s has no zoom level %d' % (self.pano_id, zoom)
+            return None
+
+        engine = engine or tiles.getDefault()
+        return engine.submit(self, zoom, callback)
+
+    def getTilesAsync(self, zoom=5, engine=None, callback=None):
+        """
+        Same as getImageAsync() but tiles are kept as raw JPEG
+        data, nothing is decoded.
+        :return: TileJob - job.result() gives dictionary
+                 (x, y) -> JPEG data
+        """
         if self.isCustom():
             raise NotImplementedError('Custom panorama is not implemented')
 
@@ -270,67 +384,35 @@ class Panorama:
             print 'Panorama %s has no zoom level %d' % (self.pano_id, zoom)
             return None
 
+        engine = engine or tiles.getDefault()
+        return engine.submit(self, zoom, callback, raw=True)
+
+    def stitchTiles(self, tiles, zoom):
+        """
+        Stitches image tiles together in order to form
+        a spherical panorama. Tiles are pasted into one image of
+        the final crop size, tiles on the right and bottom edge
+        are clipped by paste(), hence no padded canvas nor crop
+        copy is made. Tiles are removed from the dictionary once
+        pasted so that decoded tiles are released during stitching.
+        :param tiles: dictionary - (x, y) -> Image tile, consumed
+        :param zoom: int [0-5] - zoom level
+        :return: Image - panorama or None if a tile is missing
+        """
         tw, th = self.numTiles(zoom)
-        tiles = tw*th*[None]
-
-        n_threads = min(n_threads, tw*th)
-
-        sentinel = object()
-        global terminate
-        terminate = False
-        def worker(q):
-            global terminate
-            while True:
-                item = q.get()
-                if item is sentinel:
-                    q.task_done()
-                    break
-                # Recieve terminate signal
-                if terminate:
-                    q.task_done()
-                    continue
-
-                # Get tile
-                x,y = item
-                tile = self.getTile(x, y, zoom)
-                # Send terminate signal if error
-                if tile is None:
-                    terminate = True
-                # Save tile
-                tiles[y + th * x] = tile
-                q.task_done()
-
-        # Starting threads
-        q = Queue()
-
-        for x in range(n_threads):
-            t = threading.Thread(target=worker, args=(q,))
-            t.setDaemon(True)
-            t.start()
-
-        # Queueing jobs
-        for xy in product(range(tw), range(th)):
-            q.put(xy)
-        # Queueing sentinels to exit the threads
-        for _ in range(n_threads):
-            q.put(sentinel)
-        q.join()            # all jobs finished
-
-        # Stitching tiles together
-        pano = Image.new('RGB',(512*tw, 512*th))
-        grid = [xy for xy in product(range(tw), range(th))]
-
-        for x,y in grid:
+        _, _, w, h = self.cropSize(zoom)
+        img = Image.new('RGB', (w, h))
+
+        for x,y in product(range(tw), range(th)):
             try:
-                pano.paste(tiles[y+th*x], (512*x, 512*y))
+                img.paste(tiles.pop((x, y)), (512*x, 512*y))
             except Exception as e:
                 msg = self._pano_msg() + 'Error in tile stitching.'
                 loger.error(msg)
                 print msg + '\nCheck this panorama at http://maps.google.com'
                 return None
 
-        box = self.cropSize(zoom)
-        return pano.crop(box)
+        return img
 
     def getTile(self, x, y, zoom=5):
         """
@@ -340,6 +422,25 @@ class Panorama:
         :param zoom: int [0-5] - zoom level
         :return: Image - panorama tile
         """
+        msg = self.getTileData(x, y, zoom)
+        try:
+            file = BytesIO(msg)
+            #file = StringIO(msg)
+            img = Image.open(file)
+        except:
+            return None
+
+        return img
+
+    def getTileData(self, x, y, zoom=5):
+        """
+        Gets raw JPEG bytes of the panorama image tile at
+        position (x,y). The tile is not decoded.
+        :param x: int - tile coordinate horizontal
+        :param y: int - tile coordinate vertical
+        :param zoom: int [0-5] - zoom level
+        :return: string - JPEG data or None
+        """
         url ='https://geo2.ggpht.com/cbk'
         query = {
                     'output':   'tile',
@@ -349,17 +450,20 @@ class Panorama:
                     'panoid':   self.pano_id
                 }
 
-        msg = self.requestData(url,query, headers=headers)
-        try:
-            file = BytesIO(msg)
-            #file = StringIO(msg)
-            img = Image.open(file)
-        except:
+        msg = self.requestData(url,query, headers=headers, kind='tile')
+        if not msg or not msg.startswith('\xff\xd8'):     # JPEG SOI marker
             return None
-
-        return img
+        return msg
 
     def getDepthData(self):
+        """
+        Decodes depth map from the panorama metadata.
+        :return: tuple ((width w, height h), labels, planes) where
+                 labels is h x w uint8 array of plane labels and
+                 planes is n_planes x 4 float32 array, a row is a
+                 plane normal (n_0, n_1, n_2) and distance d. It is
+                 -1 if depth is not available.
+        """
         if 'model' not in self.meta.keys() or \
            'depth_map' not in self.meta['model'].keys():
             msg = 'Panorama has no depth in meta.\n%s' % (self.pano_id)
@@ -379,19 +483,15 @@ class Panorama:
         fmt = Struct('< x 3H B')            # little endian, padding byte, 3x unsigned short int, unsigned char
         n_planes, width, height, offset = fmt.unpack(data[:hsize])
 
-        # Read plane labels
+        # Read plane labels, uint8 array h x w
         n = width * height
-        fmt = Struct('%dB' % n)
-        lbls = fmt.unpack(data[offset:offset+fmt.size])
-        offset += fmt.size
-
-        # Read planes
-        fmt = Struct('< 4f')                # little endian, 4 signed floats
-        planes = []
-        for i in xrange(n_planes):
-            unpacked = fmt.unpack(data[offset:offset+fmt.size])
-            planes.append((unpacked[:3], unpacked[3]))
-            offset += fmt.size
+        lbls = np.frombuffer(data, np.uint8, n, offset).reshape((height, width))
+        offset += n
+
+        # Read planes, float32 array n_planes x 4, little endian
+        # row: (n_0, n_1, n_2, d) - plane normal and distance
+        planes = np.frombuffer(data, np.dtype('<f4'), 4*n_planes, offset)
+        planes = planes.reshape((n_planes, 4))
 
         self.depthdata = (width, height), lbls, planes
         return self.depthdata
@@ -413,42 +513,14 @@ class Panorama:
             return None
 
         size, lbls, planes = self.depthdata
-        w, h = size
-        pi = np.pi
-
-        # Rays from camera center in spherical coordinates
-        y, x = np.indices((h, w))           # grid of coordinates
-        offset = pi/2                       # no idea why not pi,
-        yaw = (w-1 - x) * 2*pi / (w-1) + offset
-        pitch = (h-1 - y) * pi / (h-1)      # 0 down, pi/2 horizontal, pi up
-
-        # Rays from spherical to cartesian
-        v = np.array([
-            np.sin(pitch) * np.cos(yaw),
-            np.sin(pitch) * np.sin(yaw),
-            np.cos(pitch)
-        ])
-        v = v.transpose(1, 2, 0)
-
-        # w x h x 3 normal, resp. w x h x 1 distance
-        n = np.array([planes[i][0] for i in lbls]).reshape((h, w, 3))
-        d = np.array([planes[i][1] for i in lbls]).reshape((h, w))
-        d[d == 0] = np.nan
-
-        # distance from camera centetr, ray inersection with plane
-        self.depthmap = d / np.abs(np.sum(v * n, axis=2))
+        self.depthmap = depth.depthMap(size, lbls, planes)
 
         try:
-            plt.imshow(self.depthmap)
+            img = Image.fromarray(colorize(self.depthmap), 'RGBA')
         except Exception as e:
             loger.error(self._pano_msg() + 'Can not export depth as an image.')
             return Image.new('RGB', (1,1))
 
-        buf = BytesIO()
-        plt.imsave(buf, self.depthmap)
-        buf.seek(0)
-        img = Image.open(buf)
-
         if zoom:
             _, _, w, h = self.cropSize(zoom)
             img = img.resize((w,h), Image.NEAREST)
@@ -456,7 +528,24 @@ class Panorama:
 
     def saveDepthData(self, fname):
         """
-        Saves depth data as JSON in following format:
+        Saves depth data. Format is given by the file extension,
+        '.json' exports JSON, otherwise a compact binary file is
+        written which can be memory-mapped by depth.load().
+
+        Google depth map is represented as a set of 3D planes.
+        Hence the depth data represent a 2D matrix which
+        corresponds to a spherical panorama. Each item of the
+        matrix is a label of a plane. Planes are given by their
+        parameters - normal vector and distance.
+
+        Binary format (little endian):
+        header - magic 'SGDM', uint8 version, pad byte,
+                 uint16 n_planes, width w, height h
+        w x h uint8 plane labels
+        padding to 4 bytes
+        n_planes x 4 float32 planes (n_0, n_1, n_2, d)
+
+        JSON format:
         data[0] - tuple (width w, height h)
         data[1] - tuple w x h plane labels
         data[2] - tuple of the length of # planes
@@ -464,12 +553,6 @@ class Panorama:
                   a component of a plane normal vector and d
                   is its distance from the camera center.
 
-        Google depth map is represented as a set of 3D planes.
-        Hence data[0], data[1] represent a 2D matrix which
-        corresponds to a spherical panorama. Each item of the
-        matrix is a label of a plane. data[2] represents
-        the plane parameters - normal vector and distance.
-
         :param fname - string, filename
         """
         if not self.depthdata:
@@ -480,8 +563,14 @@ class Panorama:
             loger.warning(msg)
             return
 
+        if not fname.endswith('.json'):
+            depth.save(fname, self.depthdata)
+            return
+
+        size, lbls, planes = self.depthdata
+        data = size, lbls.ravel().tolist(), [(p[:3], p[3]) for p in planes.tolist()]
         with open(fname, 'w') as f:
-            json.dump(self.depthdata, f)
+            json.dump(data, f)
 
     def saveDepthImage(self, fname, zoom=None):
         """
@@ -567,7 +656,7 @@ class Panorama:
         #TODO: process uncompressed depth. Is it the same as compressed?
         #TODO: what is pano map and how to use it?
 
-        msg = self.requestData(url, query, headers)
+        msg = self.requestData(url, query, headers, kind='meta')
         if not msg:
             return None
 
@@ -599,26 +688,17 @@ class Panorama:
             'output': 'json'
         }
 
-        msg = self.requestData(url, query, headers)      # .js file as string
+        msg = self.requestData(url, query, headers, kind='time_meta')    # .js file as string
         if not msg:
             return None
 
         # Handle a content of the .js file retrieved form the server
         # Here again - reverse engineered. The js file contains
-        # nested arrays with some useful info. String is
-        # modified such that it can be loaded as JOSN.
-
-        # Trash the first line
-        pattern  = r'.+\n(.+)'
-        msg = re.match(pattern, msg).groups()[0]
-        # Find '[' or ',' followed by ',' and insert 'null' in between
-        pattern = r'([\[,])(?=,)'
-        msg = re.sub(pattern, r'\1null', msg)
-
+        # nested arrays with some useful info, elided array items
+        # are nulls, see sparse.loads().
         data = None
         try:
-            # Load the JSON nested list
-            data = json.loads(msg);
+            data = sparse.loads(msg)
         except Exception as e:
             loger.warn(self._pano_msg() + 'No temporal meta JSON recieved.\n' + msg)
 
@@ -640,55 +720,127 @@ class Panorama:
         with open(fname, 'w') as f:
             json.dump(self.time_meta, f)
 
-    def saveImage(self, fname, zoom=5, n_threads=16):
+    def saveImage(self, fname, zoom=5, n_threads=16, engine=None):
         """
         Fetches panorama image at given zoom-level
         and saves as JPEG.
         :param fname: string - filename
         :param zoom: int [0-5] - zoom-level
+        :param engine: TileEngine - see getImage()
         """
-        img = self.getImage(zoom, n_threads)
+        img = self.getImage(zoom, n_threads, engine)
         try:
             img.save(fname, 'JPEG')
         except Exception as e:
             loger.error(self._pano_msg() + 'Panorama image corrupted.')
 
-    def requestData(self, url, query, headers=None):
+    def saveImageAsync(self, fname, zoom=5, engine=None, callback=None):
+        """
+        Queues panorama image at given zoom-level in a TileEngine,
+        the image is saved as JPEG once all its tiles arrive.
+        :param fname: string - filename
+        :param zoom: int [0-5] - zoom-level
+        :param engine: TileEngine, default process-wide engine
+        :param callback: function(job) - called after the image is
+                         written or failed, from an engine thread
+        :return: TileJob, None if the zoom level is not available
+        """
+        def save(job):
+            try:
+                job.result().save(fname, 'JPEG')
+            except Exception as e:
+                loger.error(self._pano_msg() + 'Panorama image corrupted.')
+            finally:
+                if callback:
+                    callback(job)
+
+        return self.getImageAsync(zoom, engine, save)
+
+    def saveTiles(self, fname, zoom=5, engine=None, wait=True, callback=None):
+        """
+        Fetches raw image tiles at given zoom-level and stores
+        them without decoding in a tar container, one member per
+        tile. Use stitchTar() to get the panorama image later.
+        :param fname: string - filename, tar container
+        :param zoom: int [0-5] - zoom-level
+        :param engine: TileEngine, default process-wide engine
+        :param wait: bool - block until the container is written
+        :param callback: function(job) - called after the container
+                         is written or failed, from an engine thread
+        :return: TileJob, None if the zoom level is not available
+        """
+        def save(job):
+            try:
+                if job.failed:
+                    loger.error(self._pano_msg() + 'Panorama tiles missing.')
+                    return
+                tiles.writeTar(fname, zoom, job.result())
+            finally:
+                if callback:
+                    callback(job)
+
+        job = self.getTilesAsync(zoom, engine, save)
+        if job and wait:
+            job.wait()
+        return job
+
+    def requestData(self, url, query, headers=None, kind=None):
         """
         Sends GET URL request formed from a base url, a query string
         and headers. Returns whatever this request receives back.
+        Request goes through the shared SessionPool, hence keep-alive
+        connections are reused. If the pool has a DiskCache, cached
+        response of the given kind is returned without a request.
         :param url: string - base URL
         :param query: dictionary - url query paramteres as key-value
         :param headers: dictionary - header parameters as key-value
+        :param kind: string - endpoint type for the cache, see
+                     DiskCache.ttl, None is never cached
         :return: dictionary - data from returned JSON
         """
         # URL GET request
         query_str = urlencode(query).encode('ascii')
-        # Repeat HTTP request if failure (e.g. unstable internet connection)
-        response = None
-
-        max_trials = 10
-        trials_remain = max_trials                  # max trials
-        while not response:
-            trials_remain -= 1
+        pool = self.pool or session.getDefault()
+
+        cache = pool.cache if kind else None
+        if cache:
+            key = cache.key(url, urlencode(sorted(query.items())))
+            msg = cache.get(key, kind)
+            if msg is not None:
+                return msg
+
+        # Repeat HTTP request if failure (e.g. unstable internet connection),
+        # transient failures are retried with backoff, see RetryPolicy
+        retry = pool.retry
+        for attempt in range(retry.max_trials):
+            response = None
             try:
-                response = requests.get(url + "?" + query_str, headers=headers)
+                response = pool.get(url + "?" + query_str, headers=headers)
                 response.raise_for_status() # raises if 4xx or 5xx error code
                 if response.status_code == 101:
                     raise GoogleUpdating
+                pool.limiter(url).succeeded()
+                break
             except GoogleUpdating:
                 loger.error('%sStatus code %d: This panorama is recently being updated. Please, try later.'\
                                 % (self._pano_msg(), 101)
                             )
                 return None
-            except Exception:
-                if trials_remain == 0:
-                    loger.warning(self._pano_msg() + 'Max trials of the URL request reached.\n' \
-                                  + response.url + '\nStatus code: ' + response.status_code)
-                    loger.exception()
+            except Exception as e:
+                status = response.status_code if response is not None else None
+                if not retry.retriable(status) or attempt == retry.max_trials - 1:
+                    loger.warning('%sURL request failed after %d trials.\n%s?%s\nStatus code: %s - %s: %s' %
+                                  (self._pano_msg(), attempt + 1, url, query_str, status,
+                                   type(e).__name__, str(e)))
                     return None
+                delay = retry.delay(attempt, response)
+                if status == 429 or status == 503:
+                    pool.limiter(url).throttled(delay)
+                time.sleep(delay)
 
         msg = response.content
+        if cache and msg:
+            cache.put(key, kind, msg)
         return msg
 
     def _utilGetNumTiles(self, zoom):
@@ -754,6 +906,41 @@ class Panorama:
 
         return s
 
+def offsetLatlng(latlng, yaw, dist):
+    """
+    Position 'dist' meters from latlng in the heading yaw, locally
+    flat Earth approximation.
+    :param latlng: tuple (lat, lng)
+    :param yaw: float - heading in degrees clockwise from north,
+                None returns latlng
+    :param dist: float - distance in meters
+    :return: tuple (lat, lng)
+    """
+    lat, lng = latlng
+    if yaw is None or lat is None or lng is None:
+        return latlng
+    r = 6371000.                        # mean Earth radius
+    a = math.radians(yaw)
+    dlat = dist * math.cos(a) / r
+    dlng = dist * math.sin(a) / (r * math.cos(math.radians(lat)))
+    return lat + math.degrees(dlat), lng + math.degrees(dlng)
+
+def stitchTar(fname, fname_out=None):
+    """
+    Stitches panorama image from a tar container written
+    by Panorama.saveTiles().
+    :param fname: string - tar container filename
+    :param fname_out: string - JPEG filename, if given the image is saved
+    :return: Image - panorama or None
+    """
+    zoom, data = tiles.readTar(fname)
+    img = Panorama().stitchTiles(
+        dict((xy, Image.open(BytesIO(d))) for xy, d in data.iteritems()), zoom
+    )
+    if img and fname_out:
+        img.save(fname_out, 'JPEG')
+    return img
+
 def str_bistr(data):
     buf = []
     for c in data:
@@ -0,0 +1,223 @@
+from email.utils import parsedate_tz, mktime_tz
+from urlparse import urlparse
+import threading
+import logging
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+loger = logging.getLogger('session')
+loger.setLevel(logging.WARNING)
+
+
+class RetryPolicy:
+    """
+    Retries with exponential backoff and full jitter, the n-th retry
+    waits random [0, min(cap, base * 2**n)] seconds. Retry-After of
+    the response is honoured. Only transient failures are retried -
+    connection errors, timeouts, 429 and 5xx status codes.
+    """
+    def __init__(self, max_trials=10, base=0.5, cap=60.):
+        """
+        :param max_trials: int - max. No. of requests
+        :param base: float - first backoff in seconds
+        :param cap: float - max. backoff in seconds
+        """
+        self.max_trials = max_trials
+        self.base = base
+        self.cap = cap
+
+    def retriable(self, status):
+        """
+        :param status: int - HTTP status code, None if no response
+        """
+        return status is None or status == 429 or status >= 500
+
+    def delay(self, attempt, response=None):
+        """
+        :param attempt: int - No. of failed trials so far minus one
+        :param response: Response - failed response or None
+        :return: float - seconds to wait before the next trial
+        """
+        after = retryAfter(response)
+        if after is not None:
+            return min(after, self.cap)
+        return random.uniform(0, min(self.cap, self.base * 2**attempt))
+
+
+def retryAfter(response):
+    """
+    :param response: Response or None
+    :return: float - seconds of the Retry-After header (delay or
+             HTTP date), None if not given
+    """
+    if response is None:
+        return None
+    value = response.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(0., float(value))
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(0., mktime_tz(date) - time.time())
+
+
+class HostLimiter:
+    """
+    Token bucket limiting request rate to one host. Every request
+    takes a token, tokens are refilled at 'rate' per second up to
+    'burst'. Throttling responses halve the rate and may hold all
+    requests to the host for a while (Retry-After), successful ones
+    raise the rate back by a small step (AIMD), hence the rate settles
+    near the highest one the server tolerates. Throttling responses
+    until the end of the hold, at least 'event' seconds, are one
+    congestion event, the rate is halved once per event.
+    """
+    min_rate = 0.5          # requests per second, lower bound after throttling
+    event = 1.              # [s] min. duration of one congestion event
+
+    def __init__(self, rate=None, burst=None):
+        """
+        :param rate: float - max. requests per second, None no limit
+                     except holds after throttling
+        :param burst: float - bucket size, default one second of requests
+        """
+        self.max_rate = rate
+        self.rate = rate
+        self.burst = burst or max(1., rate or 1.)
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.hold = 0.          # no requests until the time
+        self.cut = 0.           # end of the current congestion event
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a request can be sent. """
+        with self.lock:
+            now = time.time()
+            wait = max(0., self.hold - now)
+            if self.rate:
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                self.tokens -= 1            # reserved, may go negative
+                if self.tokens < 0:
+                    wait = max(wait, -self.tokens / self.rate)
+        if wait > 0:
+            time.sleep(wait)
+
+    def throttled(self, delay):
+        """
+        Server refused a request because of its rate.
+        :param delay: float - seconds all requests to the host wait
+        """
+        with self.lock:
+            now = time.time()
+            self.hold = max(self.hold, now + delay)
+            if now < self.cut:
+                return              # same event, e.g. requests sent before it
+            self.cut = max(self.hold, now + self.event)
+            if self.rate:
+                self.rate = max(self.min_rate, self.rate / 2.)
+                loger.warning('Throttled, request rate lowered to %.2f/s' % (self.rate,))
+
+    def succeeded(self):
+        if self.rate and self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 100.)
+
+
+class SessionPool:
+    """
+    Shared HTTP connection pool. Connections are kept alive per host
+    (geo0, geo2, cbks1, ...) and reused across Panorama instances and
+    crawler threads, hence a TLS handshake is not repeated for every
+    metadata or tile request. urllib3 pools behind the adapter are
+    thread-safe, the session is created once and never mutated
+    afterwards.
+    """
+    def __init__(self, pool_connections=8, pool_maxsize=32,
+                 pool_block=True, timeout=30, headers=None, cache=None,
+                 rate=None, retry=None):
+        """
+        :param pool_connections: int - number of per-host pools kept
+        :param pool_maxsize: int - max. keep-alive connections per host
+        :param pool_block: bool - block when all connections of a host
+                           are in use instead of opening extra ones
+        :param timeout: float - connect/read timeout in seconds
+        :param headers: dictionary - default header parameters
+        :param cache: DiskCache - response cache consulted by
+                      Panorama.requestData(), None for no cache
+        :param rate: float - max. requests per second per host,
+                     None for no limit, see HostLimiter
+        :param retry: RetryPolicy - default RetryPolicy()
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.timeout = timeout
+        self.cache = cache
+        self.rate = rate
+        self.retry = retry or RetryPolicy()
+        self.limiters = {}
+        self.lock = threading.Lock()
+
+        adapter = HTTPAdapter(pool_connections=pool_connections,
+                              pool_maxsize=pool_maxsize,
+                              pool_block=pool_block)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        if headers:
+            self.session.headers.update(headers)
+
+    def limiter(self, url):
+        """
+        :param url: string - URL
+        :return: HostLimiter - of the URL host
+        """
+        host = urlparse(url).netloc
+        with self.lock:
+            limiter = self.limiters.get(host)
+            if limiter is None:
+                limiter = self.limiters[host] = HostLimiter(self.rate)
+            return limiter
+
+    def get(self, url, headers=None):
+        """
+        Sends GET request through the pool, waits for the host limiter.
+        :param url: string - full URL including query string
+        :param headers: dictionary - header parameters as key-value
+        :return: Response
+        """
+        self.limiter(url).acquire()
+        return self.session.get(url, headers=headers, timeout=self.timeout)
+
+    def close(self):
+        self.session.close()
+
+
+_default = None
+_lock = threading.Lock()
+
+def getDefault():
+    """
+    Returns process-wide SessionPool, it is created on the first call.
+    """
+    global _default
+    with _lock:
+        if _default is None:
+            _default = SessionPool()
+        return _default
+
+def setDefault(pool):
+    """
+    Replaces process-wide SessionPool, e.g. by a pool sized
+    for the number of crawler threads.
+    :param pool: SessionPool
+    """
+    global _default
+    with _lock:
+        _default = pool
@@ -0,0 +1,315 @@
+"""
+Multi-process crawling. Pano ids are hash partitioned into shards,
+one worker process per shard. The coordinator (parent process) owns
+the database, i.e. frontier, dedup and visited records, and routes
+queued panoramas to the owning shard. Shard processes fetch and save
+panoramas and report visited records and neighbours back, hence JSON
+parsing and image decoding/encoding run on all CPU cores instead of
+contending on one GIL.
+
+Shard processes are forked from the coordinator (POSIX only) and
+inherit the crawler configuration including the area validator.
+"""
+from zlib import crc32
+from panorama import Panorama
+from session import SessionPool
+from tiles import TileEngine
+from crawler import Crawler
+from cache import DiskCache
+from collections import deque
+import multiprocessing
+import Queue
+import threading
+import logging
+import signal
+import thread
+import time
+import panorama
+import session
+
+loger = logging.getLogger('sharded')
+loger.setLevel(logging.DEBUG)
+
+
+def shardOf(pano_id, n):
+    """
+    :param pano_id: string - pano id hash
+    :param n: int - No. of shards
+    :return: int - shard owning the pano id
+    """
+    return (crc32(pano_id) & 0xffffffff) % n
+
+
+class ShardedCrawler(Crawler):
+    """
+    Crawler running n_proc shard processes, each with n_thr crawling
+    threads and its own tile engine and connection pool. Per host
+    rate limit and cache size are split evenly among shards. A shard
+    gets at most window panoramas ahead. Panoramas of shards with
+    a full inbox are parked, a slow shard does not stall routing to
+    the others until 'backlog' panoramas are parked. The rest stays
+    in the database frontier. Panoramas of a died shard are queued
+    again and its pano ids are routed to the remaining shards.
+
+    Messages of shard processes to the coordinator:
+        ('visit', pano_id, record or None, [(pano_id, priority), ...])
+        ('done', shard, stats)
+    """
+    window = 2                      # queued panoramas per shard thread
+    backlog = 1000                  # max. panoramas parked for full shards
+    poll = 0.05                     # [s] wait of dispatcher on full shards
+    check = 1.                      # [s] period of checking shard processes
+
+    def __init__(self, n_proc=None, **kwargs):
+        """
+        :param n_proc: int - No. of shard processes, default No. of CPUs
+        :param kwargs: see Crawler
+        """
+        Crawler.__init__(self, **kwargs)
+        self.n_proc = n_proc or multiprocessing.cpu_count()
+        self.rate = kwargs.get('rate')
+        self.procs = []
+        self.inboxes = []
+        self.results = None
+        self.dispatcher = None
+        self.collector = None
+        self.lock = threading.Lock()
+        self.owner = {}             # pano id in a shard -> shard
+        self.finished = set()       # shards exited normally
+        self.dead = set()
+        self.stopping = False
+
+    # Shard process
+    # -------------
+
+    def shard(self, id):
+        signal.signal(signal.SIGINT, signal.SIG_IGN)    # coordinator stops shards
+        loger.debug('Starting shard %d' % (id,))
+        self.db = None                                  # owned by the coordinator
+        self.n_pruned = 0
+        panorama.metaCache.clear()
+        if self.cache:
+            # Shards index and evict disjoint partitions of the
+            # cache, each up to its share of max_size
+            c = self.cache
+            self.cache = DiskCache(c.root, c.max_size / self.n_proc, c.ttl,
+                                   part=(id, self.n_proc))
+
+        # Threads and connections do not survive fork
+        rate = self.rate / self.n_proc if self.rate else None
+        self.tiles = TileEngine(self.n_tiles)
+        self.pool = SessionPool(pool_maxsize=max(self.n_conn, self.n_tiles),
+                                cache=self.cache, rate=rate)
+        session.setDefault(self.pool)
+
+        inbox = self.inboxes[id]
+        threads = [threading.Thread(target=self.shardWorker, args=(id, j, inbox))
+                   for j in range(self.n_thr)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.tiles.join()                               # images still in flight
+
+        mc = panorama.metaCache
+        stats = {
+            'pruned': self.n_pruned,
+            'cache': (self.cache.hits, self.cache.misses) if self.cache else (0, 0),
+            'meta': (mc.hits, mc.misses)
+        }
+        self.results.put(('done', id, stats))
+        loger.debug('Exiting shard %d' % (id,))
+
+    def shardWorker(self, id, j, inbox):
+        while True:
+            pano_id = inbox.get()
+            if pano_id is None:
+                break
+            data, neighbours = None, []
+            reported = False
+            try:
+                p = Panorama(pano_id, pool=self.pool)
+                pbase = self.panoBase(p)
+                if pbase:
+                    self.savePanoMeta(p, pbase)
+                data, neighbours = self.discover(p)
+                if pbase:
+                    # reported once its media is saved
+                    msg = ('visit', pano_id, data, neighbours)
+                    reported = True
+                    self.savePanoMedia(p, pbase, self.zoom,
+                                       done=lambda msg=msg: self.results.put(msg))
+            except Exception as e:
+                msg = 'Shard %d thread %d - %s:%s' % (id, j, type(e).__name__, str(e))
+                loger.error(msg)
+            finally:
+                if not reported:
+                    self.results.put(('visit', pano_id, data, neighbours))
+
+    # Coordinator
+    # -----------
+
+    def dispatch(self):
+        """
+        Moves panoramas from the database frontier (BFS or nearest
+        first order) to the inboxes of the owning shards. Panoramas
+        of full inboxes are parked, the frontier is read on only
+        while less than backlog panoramas are parked.
+        """
+        parked = [deque() for _ in self.inboxes]
+        n_parked = 0
+        while not self.stopping:
+            n_parked -= self.route(parked)
+            if n_parked >= self.backlog or (n_parked and self.db.qempty()):
+                time.sleep(self.poll)           # shards are busy
+                continue
+            pano_id = self.db.dequeue()         # blocks only if nothing is parked
+            if self.db.isSentinel(pano_id):
+                self.db.task_done()
+                break
+            parked[shardOf(pano_id, self.n_proc)].append(pano_id)
+            n_parked += 1
+
+        # parked panoramas are left in the frontier
+        for q in parked:
+            for pano_id in q:
+                self.db.release(pano_id)
+        for id, inbox in enumerate(self.inboxes):
+            for _ in range(self.n_thr):
+                while self.procs[id].is_alive():
+                    try:
+                        inbox.put(None, timeout=self.check)     # exits shard thread
+                        break
+                    except Queue.Full:
+                        pass
+
+    def route(self, parked):
+        """
+        Moves parked panoramas into inboxes with free room, panoramas
+        of died shards are parked for the remaining ones first.
+        :param parked: list of deques - parked pano ids per shard
+        :return: int - No. of routed panoramas
+        """
+        alive = [id for id in range(self.n_proc) if id not in self.dead]
+        for id in self.dead:
+            if not alive:
+                break
+            for pano_id in parked[id]:
+                parked[alive[shardOf(pano_id, len(alive))]].append(pano_id)
+            parked[id].clear()
+
+        n = 0
+        for id in alive:
+            inbox, q = self.inboxes[id], parked[id]
+            while q:
+                with self.lock:
+                    self.owner[q[0]] = id
+                    try:
+                        inbox.put_nowait(q[0])
+                    except Queue.Full:
+                        del self.owner[q[0]]
+                        break
+                q.popleft()
+                n += 1
+        return n
+
+    def collect(self):
+        """
+        Applies results of shard processes to the database, a panorama
+        is done once its neighbours are queued. Results of panoramas
+        queued again meanwhile (see reap()) are applied but the
+        panoramas are not done.
+        """
+        checked = time.time()
+        while len(self.finished | self.dead) < self.n_proc:
+            try:
+                msg = self.results.get(timeout=self.check)
+            except Queue.Empty:
+                self.reap()                     # results of died shards drained
+                checked = time.time()
+                continue
+            if not self.stopping and time.time() - checked > self.check:
+                self.reap()
+                checked = time.time()
+            if msg[0] == 'done':
+                self.merge(msg[2])
+                self.finished.add(msg[1])
+                continue
+            _, pano_id, data, neighbours = msg
+            with self.lock:
+                current = self.owner.pop(pano_id, None) is not None
+            try:
+                for n, prio in neighbours:
+                    self.db.enqueue(n, prio)
+                if data:
+                    self.db.add(pano_id, data)
+            except Exception as e:
+                loger.error('Collector - %s:%s' % (type(e).__name__, str(e)))
+            finally:
+                if current:
+                    self.db.task_done(pano_id)
+
+    def reap(self):
+        """
+        Detects died shard processes. Their panoramas not reported
+        yet are queued again. The crawl is interrupted if all shards
+        died.
+        """
+        with self.lock:
+            for id, p in enumerate(self.procs):
+                if id in self.dead or id in self.finished or p.is_alive():
+                    continue
+                self.dead.add(id)
+                lost = [k for k, s in self.owner.iteritems() if s == id]
+                for pano_id in lost:
+                    del self.owner[pano_id]
+                    self.db.release(pano_id)
+                loger.error('Shard %d died (exit code %s), %d panoramas queued again' %
+                            (id, p.exitcode, len(lost)))
+                if len(self.dead) == self.n_proc and not self.stopping:
+                    print 'All shard processes died'
+                    thread.interrupt_main()     # saves the crawl, see run()
+
+    def merge(self, stats):
+        # counters of a finished shard, reported by onexit()
+        self.n_pruned += stats['pruned']
+        if self.cache:
+            self.cache.hits += stats['cache'][0]
+            self.cache.misses += stats['cache'][1]
+        mc = panorama.metaCache
+        mc.hits += stats['meta'][0]
+        mc.misses += stats['meta'][1]
+
+    def startThreads(self):
+        self.db.cleanSentinels()
+        self.results = multiprocessing.Queue()
+        self.inboxes = [multiprocessing.Queue(self.window * self.n_thr)
+                        for _ in range(self.n_proc)]
+
+        # processes are forked before coordinator threads start
+        self.procs = [multiprocessing.Process(target=self.shard, args=(j,))
+                      for j in range(self.n_proc)]
+        for p in self.procs:
+            p.daemon = True
+            p.start()
+
+        self.dispatcher = threading.Thread(target=self.dispatch)
+        self.collector = threading.Thread(target=self.collect)
+        self.dispatcher.start()
+        self.collector.start()
+        loger.debug('%d shards started' % (self.n_proc,))
+
+    def stopThreads(self):
+        """
+        Panoramas already in shard inboxes are finished, the
+        rest stays in the database frontier.
+        """
+        loger.debug('Stopping shards...')
+        self.stopping = True
+        self.db.prependSentinel()           # sentinel exits dispatcher
+        self.dispatcher.join()
+        self.db.cleanSentinels()            # not dequeued if dispatcher was waiting
+        self.collector.join()
+        for p in self.procs:
+            p.join()
+        loger.debug('Shards stopped')
@@ -0,0 +1,172 @@
+"""
+Parser of Google's sparse-array JS payloads, e.g. timemachine
+metadata. Payload starts with a junk line followed by a nested
+JS array literal with elided elements, '[1,,2]' stands for
+[1, null, 2]. It is not JSON, json.loads() can not read it.
+"""
+from json.decoder import scanstring
+import json
+import random
+import re
+import timeit
+
+# Tokens of the array literal: structural character, string,
+# number or keyword. Leading white space is skipped.
+_token = re.compile(r'''
+    \s*(?:
+        ([\[\],])                                   # structural
+      | "                                           # string, see scanstring
+      | (-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?)          # number
+      | (true|false|null)                           # keyword
+    )''', re.VERBOSE)
+
+_keywords = {'true': True, 'false': False, 'null': None}
+
+
+def body(msg):
+    """
+    :param msg: string - payload as returned by the server
+    :return: string - the array literal, i.e. the second line
+    """
+    i = msg.index('\n') + 1
+    j = msg.find('\n', i)
+    return msg[i:] if j < 0 else msg[i:j]
+
+
+def loads(msg):
+    """
+    Parses the payload. Elided elements are filled with null by
+    str.replace() and the literal is parsed by the C JSON decoder,
+    the output equals the previous regex based approach at half
+    the cost. Literals the JSON decoder rejects (e.g. trailing
+    commas) are parsed by parse().
+    :param msg: string - payload as returned by the server
+    :return: list - nested lists, elided elements are None
+    """
+    s = body(msg)
+    t = s.replace('[,', '[null,').replace(',,', ',null,').replace(',,', ',null,')
+    try:
+        return json.loads(t)
+    except ValueError:
+        return parse(s)
+
+
+def parse(s):
+    """
+    Parses a sparse JS array literal in one pass, nested lists are
+    built directly. Commas inside strings are left untouched. Pure
+    Python, about 3x slower than loads(), see benchmark().
+    :param s: string - array literal
+    :return: list - nested lists, elided elements are None
+    """
+    match = _token.match
+    stack = []
+    top = None
+    elided = False      # element position opened by '[' or ','
+    i = 0
+    while True:
+        m = match(s, i)
+        if m is None:
+            if s[i:].strip():
+                raise ValueError('Unexpected character at %d' % (i,))
+            raise ValueError('Unterminated array')
+        c, num, kw = m.groups()
+        i = m.end()
+        if c == ',':
+            if elided:
+                top.append(None)        # '[,' or ',,'
+            elided = True
+            continue
+        if c == ']':
+            stack.pop()
+            if not stack:
+                return top
+            top = stack[-1]
+            elided = False
+            continue
+        if c == '[':
+            val = []
+            if top is not None:
+                top.append(val)
+            stack.append(val)
+            top = val
+            elided = True
+            continue
+        if num is not None:
+            val = float(num) if '.' in num or 'e' in num or 'E' in num else int(num)
+        elif kw is not None:
+            val = _keywords[kw]
+        else:
+            val, i = scanstring(s, i)
+        if top is None:
+            raise ValueError('Expected array at %d' % (m.start(),))
+        top.append(val)
+        elided = False
+
+
+def loadsRegex(msg):
+    """
+    Previous approach, nulls inserted by a regex and the result
+    parsed as JSON, kept for the benchmark.
+    """
+    msg = re.match(r'.+\n(.+)', msg).groups()[0]
+    msg = re.sub(r'([\[,])(?=,)', r'\1null', msg)
+    return json.loads(msg)
+
+
+# Benchmark
+# ---------
+
+def _sample(depth=0, rnd=random):
+    # random nested list resembling timemachine metadata
+    out = []
+    for _ in range(rnd.randint(1, 12 if depth < 3 else 6)):
+        r = rnd.random()
+        if r < 0.3:
+            out.append(None)
+        elif r < 0.45 and depth < 7:
+            out.append(_sample(depth + 1, rnd))
+        elif r < 0.6:
+            out.append(rnd.randint(-1000, 10**6))
+        elif r < 0.75:
+            out.append(round(rnd.uniform(-180, 180), 7))
+        elif r < 0.97:
+            out.append(''.join(rnd.choice('AZaz09_- ./') for _ in range(rnd.randint(1, 30))))
+        else:
+            out.append(u'Stre\u0161n\xed "n\xe1m" 12, Praha')
+    while out and out[-1] is None:
+        out.pop()                       # no trailing holes in the format
+    return out
+
+def _dumps(data):
+    # sparse JS literal of the nested list
+    if isinstance(data, list):
+        return '[' + ','.join('' if x is None else _dumps(x) for x in data) + ']'
+    return json.dumps(data)
+
+def _payload(size, seed=0):
+    rnd = random.Random(seed)
+    data = [[], [[]]]
+    while len(_dumps(data)) < size:
+        data[1][0].append(_sample(0, rnd))
+    return ")]}'\n" + _dumps(data), data
+
+def benchmark(size=30000, number=200):
+    """
+    Compares parsers on a synthetic payload of the given size,
+    prints ms per payload. Strings of the payload contain no ',,',
+    hence all parsers give the same output.
+    """
+    msg, data = _payload(size)
+    parsers = [
+        ('regex', loadsRegex),
+        ('loads', loads),
+        ('parse', lambda msg: parse(body(msg)))
+    ]
+    for name, f in parsers:
+        assert f(msg) == data, name
+        t = min(timeit.repeat(lambda: f(msg), repeat=3, number=number))
+        print '%-8s %7.3f ms' % (name, 1000. * t / number)
+
+if __name__ == '__main__':
+    benchmark()
@@ -7,7 +7,11 @@ Usage:
     streetget box PID     W H [options] LABEL
     streetget gpsbox LAT LNG LAT_TL LNG_TL LAT_BR LNG_BR [options] LABEL
     streetget gpsbox PID     LAT_TL LNG_TL LAT_BR LNG_BR [options] LABEL
+    streetget polygon LAT LNG FILE [options] LABEL
+    streetget polygon PID     FILE [options] LABEL
     streetget resume DIR LABEL
+    streetget worker HOST PORT [options]
+    streetget stitch [options] LABEL
     streetget info ((LAT LNG) | PID)
     streetget show PID
 
@@ -21,10 +25,22 @@ Commands:
                         defined by top-left corner LAT_TL, LNG_TL
                         and bottom-right corner LAT_BR, LNG_BR. Download
                         starts at location LAT, LNG
+    polygon             Downloads street-view inside polygons (e.g. city
+                        boundaries, holes allowed) read from GeoJSON
+                        or WKT file FILE. Download starts at location
+                        LAT, LNG
     resume              Resumes interrupted downloading. Only
                         directory flag -D DIR is allowed. Other
                         flags will be restored from the interrupted
                         session.
+    stitch              Stitches panorama images from tile containers
+                        saved with the -R flag. Existing images are
+                        skipped.
+    worker              Crawls panoramas leased from the coordinator
+                        at HOST, PORT (see -S) and saves them under
+                        the root directory -D. The area and flags of
+                        the crawl are set by the coordinator, only
+                        flags -D, -a, -c, -r and -w are local.
     info                Prints info about the closest panorama at LAT,
                         LNG position or info about panorama id PID.
     show                Shows panorama image at zoom level 2 in default
@@ -38,6 +54,8 @@ Arguments:
     DIR                 Directory containing collected datasets.
     W, H                Width and height in meters.
     R                   Radius in meters.
+    FILE                GeoJSON or WKT file with (multi)polygons.
+    HOST, PORT          Coordinator address.
 
 NOTE:
     A MINUS sign (dash) is NOT allowed for negative numbers. Instead use letter
@@ -47,6 +65,38 @@ Options:
     -t          Time machine, include temporal panorama neighbours.
     -i          Save images, if unset only metadata are fetched and saved.
     -d          Save depth data and depth map thumbnails at zoom level 0.
+    -j          Export depth data as JSON instead of the compact
+                binary format.
+    -a          Fetch images asynchronously on one shared tile engine,
+                crawling does not wait for image downloads.
+    -R          Save raw image tiles per panorama in a tar container
+                without decoding, see the stitch command.
+    -n          Nearest-first crawling, panoramas closer to the area
+                center are downloaded first instead of BFS order.
+    -p SLACK    Skip neighbours estimated more than SLACK meters outside
+                the area without fetching them. Saves requests along the
+                area border, panoramas closer than about 10 m to the
+                border may be missed. Use 0 for most savings.
+    -c DIR      Cache HTTP responses (metadata, tiles) in the directory,
+                shared by crawls, e.g. re-crawls with other zoom levels.
+    -r RATE     Max. requests per second to each server host, lowered
+                automatically when the server throttles.
+    -b BACKEND  Crawl state storage, 'journal' (snapshot and append-only
+                journal) or 'sqlite' (SQLite db in WAL mode)
+                [default: journal]
+    -S PORT     Serve the crawl state to remote workers on TCP port
+                PORT instead of crawling, see the worker command.
+    -H HOST     Interface the -S server listens on. The protocol is not
+                authenticated and the crawl arguments served include
+                local paths, use 0.0.0.0 on trusted networks only
+                [default: 127.0.0.1]
+    -P NPROC    Crawl with NPROC worker processes, pano ids are
+                sharded among processes by hash.
+    -m N        Download images and depth data by N threads of their
+                own, crawling threads only discover panoramas and
+                fetch metadata.
+    -w N        Number of tile download threads shared by all
+                panoramas of the crawl [default: 32]
     -z ZOOM     Comma separated panorama zoom levels [0-5] to be
                 download [default: 0,5]
     -D DIR      Root directory. [default: ./]
@@ -60,7 +110,11 @@ import sys
 import logging
 from docopt import docopt
 from crawler import Crawler
+from sharded import ShardedCrawler
+from distributed import Coordinator, Worker
+import distributed
 from panorama import Panorama
+from panorama import stitchTar
 
 
 class Arguments:
@@ -70,6 +124,21 @@ class Arguments:
     time = None
     images = None
     depth = None
+    depth_json = None
+    async_images = None
+    n_tiles = None
+    raw_tiles = None
+    backend = None
+    nearest = None
+    cache = None
+    rate = None
+    n_proc = None
+    n_media = None
+    prune_slack = None
+    serve = None
+    bind = None
+    host = None
+    port = None
     zoom = None
     latlng = None
     panoid = None
@@ -78,7 +147,11 @@ class Arguments:
     circle = None
     box = None
     gpsbox = None
+    polygon = None
+    area = None
     resume = None
+    worker = None
+    stitch = None
     info = None
     show = None
     pvalid = None
@@ -108,15 +181,18 @@ def parse(args):
         Panorama(pano_id=args.panoid).getImage(2).show()
         return
 
-    # Setting up loger
-    fdir = os.path.join(args.root, args.label)
-    if not os.path.exists(fdir):
-        os.makedirs(fdir)
+    # Stitch command
+    if args.stitch:
+        stitch(os.path.join(args.root, args.label))
+        return
 
-    l_fmt = '%(asctime)s %(levelname)s [%(filename)s:%(lineno)s - %(funcName)10s() ]: %(message)s'        # format
-    l_dfmt = '%m/%d/%Y %I:%M:%S %p'                         # date format
-    l_fname = os.path.join(args.root, args.label, 'crawler.log')  # filepath
-    logging.basicConfig(filename=l_fname, format=l_fmt, datefmt=l_dfmt)
+    # Worker command
+    if args.worker:
+        work(args)
+        return
+
+    # Setting up loger
+    setupLog(args)
 
     # Filename for command restore
     fname = os.path.join(args.root, args.label, 'crawlerArgs.pickle')
@@ -132,6 +208,23 @@ def parse(args):
             msg = '\n"%s" already crawled. Use "resume" (see --help) to continue crawling.' % (args.label,)
             raise AssertionError(msg)
 
+    pvalid = areaValidator(args)
+
+    with open(fname, 'w') as f:
+        pickle.dump(args, f)
+    launch(args, pvalid)
+
+def setupLog(args):
+    fdir = os.path.join(args.root, args.label)
+    if not os.path.exists(fdir):
+        os.makedirs(fdir)
+
+    l_fmt = '%(asctime)s %(levelname)s [%(filename)s:%(lineno)s - %(funcName)10s() ]: %(message)s'        # format
+    l_dfmt = '%m/%d/%Y %I:%M:%S %p'                         # date format
+    l_fname = os.path.join(args.root, args.label, 'crawler.log')  # filepath
+    logging.basicConfig(filename=l_fname, format=l_fmt, datefmt=l_dfmt)
+
+def areaValidator(args):
     # Create area validator for crawler
     if args.circle:
         if args.latlng:
@@ -140,25 +233,99 @@ def parse(args):
             pvalid = validator.circle(pid_origin=args.panoid, radius=args.r)
     elif args.box:
         if args.latlng:
-            pvalid = validator.circle(latlng_origin=args.latlng, width=args.w, height=args.h)
+            pvalid = validator.box(latlng_origin=args.latlng, width=args.w, height=args.h)
         else:
-            pvalid = validator.circle(pid_origin=args.pid, width=args.w, height=args.h)
-
-        # pvalid = validator.box(a.latlng, a.w, a.h)
+            pvalid = validator.box(pid_origin=args.panoid, width=args.w, height=args.h)
     elif args.gpsbox:
         pvalid = validator.gpsbox(args.topleft, args.btmright)
+    elif args.polygon:
+        pvalid = validator.polygon(args.area, latlng_origin=args.latlng, pid_origin=args.panoid)
     else:
         raise NotImplementedError('Unknown validator')
+    return pvalid
 
-    with open(fname, 'w') as f:
-        pickle.dump(args, f)
-    launch(args, pvalid)
+def stitch(fdir):
+    """
+    Stitches JPEG panoramas from all tile containers in the
+    dataset directory.
+    :param fdir: string - dataset directory
+    """
+    for dpath, dnames, fnames in os.walk(fdir):
+        for f in sorted(fnames):
+            if not f.endswith('.tar'):
+                continue
+            fname = os.path.join(dpath, f)
+            fname_out = fname[:-len('.tar')] + '.jpg'
+            if os.path.exists(fname_out):
+                continue
+            print fname_out
+            stitchTar(fname, fname_out)
+
+def crawlerArgs(args, pvalid):
+    return dict(pano_id=args.panoid, latlng=args.latlng, validator=pvalid,
+                  label=args.label, root=args.root, zoom=args.zoom,
+                  images=args.images, depth=args.depth, time=args.time,
+                  async_images=args.async_images, n_tiles=args.n_tiles,
+                  raw_tiles=args.raw_tiles, depth_json=args.depth_json,
+                  backend=args.backend or 'journal', nearest=args.nearest,
+                  cache=args.cache, rate=args.rate, n_media=args.n_media,
+                  prune_slack=args.prune_slack
+                  )
 
 def launch(args, pvalid):
-    c = Crawler(pano_id=args.panoid, latlng=args.latlng, validator=pvalid,
-                label=args.label, root=args.root, zoom=args.zoom,
-                images=args.images, depth=args.depth, time=args.time
-                )
+    kwargs = crawlerArgs(args, pvalid)
+    if args.serve:
+        c = Coordinator(args.serve, host=args.bind or '127.0.0.1',
+                        config=workerConfig(args), **kwargs)
+    elif args.n_proc and args.n_proc > 1:
+        c = ShardedCrawler(n_proc=args.n_proc, **kwargs)
+    else:
+        c = Crawler(**kwargs)
+    c.run()
+
+def workerConfig(args):
+    """
+    Crawl arguments served to workers, area file is sent along.
+    :return: dictionary - JSON serializable
+    """
+    config = dict(vars(args))
+    config['area_data'] = None
+    if args.area:
+        with open(args.area) as f:
+            config['area_data'] = f.read()
+    return config
+
+def work(args):
+    """
+    Runs worker with crawl arguments of the coordinator,
+    see distributed.Worker.
+    """
+    config = distributed.fetchConfig(args.host, args.port)
+    a = Arguments()
+    for k, v in config.iteritems():
+        setattr(a, str(k), v)
+    a.label = str(a.label)
+    a.panoid = str(a.panoid) if a.panoid else None
+    for k in ('latlng', 'topleft', 'btmright'):
+        v = getattr(a, k)
+        setattr(a, k, tuple(v) if v else v)
+
+    # Local flags
+    a.root = args.root
+    a.async_images = args.async_images
+    a.cache = args.cache
+    a.rate = args.rate
+    a.n_tiles = args.n_tiles
+    setupLog(a)
+
+    if a.area_data is not None:         # area file of the coordinator
+        a.area = os.path.join(a.root, a.label, os.path.basename(a.area))
+        with open(a.area, 'w') as f:
+            f.write(a.area_data)
+
+    print '\nWorking on:'
+    print a.cmds + '\n'
+    c = Worker(args.host, args.port, **crawlerArgs(a, areaValidator(a)))
     c.run()
 
 def main():
@@ -180,25 +347,44 @@ def main():
     a.images = args['-i']
     a.zoom = map(lambda x: int(x), args['-z'].split(','))
     a.depth = args['-d']
+    a.depth_json = args['-j']
+    a.async_images = args['-a']
+    a.n_tiles = int(args['-w'])
+    a.raw_tiles = args['-R']
+    a.backend = args['-b']
+    a.nearest = args['-n']
+    a.cache = args['-c']
+    a.rate = float(args['-r']) if args['-r'] else None
+    a.n_proc = int(args['-P']) if args['-P'] else None
+    a.n_media = int(args['-m']) if args['-m'] else None
+    a.prune_slack = float(args['-p']) if args['-p'] else None
+    a.serve = int(args['-S']) if args['-S'] else None
+    a.bind = args['-H']
 
     # Area downloading stuff
     a.circle = args['circle']
     a.box = args['box']
     a.gpsbox = args['gpsbox']
+    a.polygon = args['polygon']
 
     # Auxiliary commands
     a.resume = args['resume']
+    a.worker = args['worker']
+    a.stitch = args['stitch']
     a.info = args['info']
     a.show = args['show']
 
     # Params of area
     a.r = tofloat(args['R'])
     a.w,a.h = tofloat(args['W']), tofloat(args['H'])
+    a.area = os.path.abspath(args['FILE']) if args['FILE'] else None
 
     # GPS stuff
     a.latlng = (tofloat(args['LAT']), tofloat(args['LNG']))
     a.latlng = None if a.latlng[0] is None else a.latlng
     a.panoid = args['PID']
+    a.host = args['HOST']
+    a.port = int(args['PORT']) if args['PORT'] else None
     a.topleft = tofloat(args['LAT_TL']), tofloat(args['LNG_TL'])
     a.btmright = tofloat(args['LAT_BR']), tofloat(args['LNG_BR'])
 
@@ -0,0 +1,223 @@
+from queue import Queue
+from itertools import product
+from io import BytesIO
+import threading
+import tarfile
+import os
+import logging
+import re
+
+loger = logging.getLogger('tiles')
+loger.setLevel(logging.WARNING)
+
+
+class TileJob:
+    """
+    Tiles of one panorama image at given zoom-level queued in
+    a TileEngine. Tiles are collected as they arrive. The job is
+    done when all its tiles were processed, after the first failed
+    tile the remaining ones are skipped. Waiting callers are released
+    after the callback returned. Raw job keeps JPEG data
+    of tiles, tiles are not decoded.
+    """
+    def __init__(self, pano, zoom, callback=None, raw=False):
+        """
+        :param pano: Panorama - tiles owner
+        :param zoom: int [0-5] - zoom level
+        :param callback: function(job) - called from engine thread
+                         when the job is done
+        :param raw: bool - keep raw JPEG data instead of Images
+        """
+        self.pano = pano
+        self.zoom = zoom
+        self.callback = callback
+        self.raw = raw
+        tw, th = pano.numTiles(zoom)
+        self.grid = list(product(range(tw), range(th)))
+        self.tiles = {}
+        self.image = None               # stitched by result()
+        self.failed = False
+        self.pending = len(self.grid)
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+
+    def fetch(self, x, y):
+        tile = None
+        if not self.failed:
+            try:
+                if self.raw:
+                    tile = self.pano.getTileData(x, y, self.zoom)
+                else:
+                    tile = self.pano.getTile(x, y, self.zoom)
+            except Exception as e:
+                loger.error('%s tile (%d, %d) - %s: %s' %
+                            (self.pano.pano_id, x, y, type(e).__name__, str(e)))
+
+        with self.lock:
+            if tile is None:
+                self.failed = True
+            else:
+                self.tiles[(x, y)] = tile
+            self.pending -= 1
+            last = self.pending == 0
+
+        if last:
+            try:
+                if self.callback:
+                    self.callback(self)
+            finally:
+                self.event.set()        # waiting callers see the callback done
+
+    def done(self):
+        return self.event.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until all tiles are processed.
+        :return: boolean - True if the job is done
+        """
+        return self.event.wait(timeout)
+
+    def result(self):
+        """
+        Waits for the tiles and stitches them together. Tiles are
+        released by stitching, the image is kept and returned by
+        later calls.
+        :return: Image - panorama or None if a tile is missing,
+                 raw job returns dictionary (x, y) -> JPEG data
+        """
+        if self.pending:
+            self.wait()
+        if self.raw:
+            return None if self.failed else self.tiles
+        with self.lock:
+            if self.image is None and not self.failed:
+                self.image = self.pano.stitchTiles(self.tiles, self.zoom)
+                self.failed = self.image is None
+            return self.image
+
+
+'''
+When sentinel is found in the engine queue
+it terminates worker thread.
+'''
+class Sentinel:
+    pass
+
+
+class TileEngine:
+    """
+    Long-lived pool of tile fetching threads. Tiles of all submitted
+    panoramas share one queue, hence the number of threads is a global
+    cap on concurrent tile requests. Submitting blocks while max_jobs
+    images are in flight, which bounds memory held by fetched tiles.
+    """
+    def __init__(self, n_threads=16, max_jobs=None):
+        """
+        :param n_threads: int - number of tile fetching threads
+        :param max_jobs: int - max. images in flight, default 2*n_threads
+        """
+        self.n_threads = n_threads
+        self.q = Queue()
+        self.slots = threading.BoundedSemaphore(max_jobs or 2*n_threads)
+        self.threads = []
+        for j in range(n_threads):
+            t = threading.Thread(target=self.worker)
+            t.setDaemon(True)
+            t.start()
+            self.threads.append(t)
+
+    def submit(self, pano, zoom, callback=None, raw=False):
+        """
+        Queues all tiles of the panorama at given zoom level.
+        :param pano: Panorama
+        :param zoom: int [0-5] - zoom level
+        :param callback: function(job) - called when the job is done
+        :param raw: bool - see TileJob
+        :return: TileJob
+        """
+        def release(job):
+            self.slots.release()
+            if callback:
+                callback(job)
+
+        self.slots.acquire()
+        job = TileJob(pano, zoom, release, raw)
+        for x, y in job.grid:
+            self.q.put((job, x, y))
+        return job
+
+    def worker(self):
+        while True:
+            item = self.q.get()
+            if isinstance(item, Sentinel):
+                self.q.task_done()
+                break
+            job, x, y = item
+            try:
+                job.fetch(x, y)
+            except Exception as e:
+                loger.error('Tile callback - %s: %s' % (type(e).__name__, str(e)))
+            finally:
+                self.q.task_done()
+
+    def join(self):
+        """ Blocks until all submitted tiles are processed. """
+        self.q.join()
+
+    def shutdown(self, wait=True):
+        for _ in self.threads:
+            self.q.put(Sentinel())
+        if wait:
+            for t in self.threads:
+                t.join()
+
+
+def writeTar(fname, zoom, tiles):
+    """
+    Writes raw JPEG tiles into a tar container. Members are named
+    'zoom_x_y.jpg'. The container is written to a temporary file
+    first, hence an interrupted crawl does not leave partial tars.
+    :param fname: string - tar filename
+    :param zoom: int [0-5] - zoom level
+    :param tiles: dictionary - (x, y) -> JPEG data
+    """
+    tmp = fname + '.tmp'
+    with tarfile.open(tmp, 'w') as tar:
+        for (x, y) in sorted(tiles.keys()):
+            data = tiles[(x, y)]
+            info = tarfile.TarInfo('%d_%d_%d.jpg' % (zoom, x, y))
+            info.size = len(data)
+            tar.addfile(info, BytesIO(data))
+    os.rename(tmp, fname)
+
+def readTar(fname):
+    """
+    Reads tar container written by writeTar().
+    :param fname: string - tar filename
+    :return: tuple (zoom, dictionary (x, y) -> JPEG data)
+    """
+    zoom = None
+    tiles = {}
+    with tarfile.open(fname, 'r') as tar:
+        for info in tar:
+            m = re.match(r'(\d+)_(\d+)_(\d+)\.jpg$', info.name)
+            if not m:
+                continue
+            zoom, x, y = map(int, m.groups())
+            tiles[(x, y)] = tar.extractfile(info).read()
+    return zoom, tiles
+
+
+_default = None
+_lock = threading.Lock()
+
+def getDefault():
+    """
+    Returns process-wide TileEngine, it is created on the first call.
+    """
+    global _default
+    with _lock:
+        if _default is None:
+            _default = TileEngine()
+        return _default
@@ -1,7 +1,85 @@
 import utm
-from math import sqrt
+import json
+import re
+import numpy as np
+from math import cos, radians
+import math
 from panorama import Panorama
 
+R_EARTH = 6371000.      # mean Earth radius in meters
+
+# WGS84 constants of the transverse Mercator projection, see utm package
+K0 = 0.9996
+E = 0.00669438
+E2 = E * E
+E3 = E2 * E
+E_P2 = E / (1.0 - E)
+M1 = (1 - E / 4 - 3 * E2 / 64 - 5 * E3 / 256)
+M2 = (3 * E / 8 + 3 * E2 / 32 + 45 * E3 / 1024)
+M3 = (15 * E2 / 256 + 45 * E3 / 1024)
+M4 = (35 * E3 / 3072)
+R = 6378137
+
+def projection(latlng_origin):
+    """
+    UTM projection fixed to the zone of the origin, the zone and
+    the origin are computed once. The same formulas as the utm
+    package, but on numpy arrays and without the false northing
+    of the southern hemisphere, i.e. continuous across the equator.
+    :param latlng_origin: tuple (lat, lng) - origin GPS
+    :return: function(lat, lng) - returns tuple (x, y) of meters
+             east and north of the origin, lat and lng are floats
+             or numpy arrays
+    """
+    zone = utm.from_latlon(latlng_origin[0], latlng_origin[1])[2]
+    central = radians((zone - 1) * 6 - 180 + 3)
+
+    def tm(lat, lng, xp=np):
+        # xp - numpy for arrays, math module is faster for scalars
+        lat = xp.radians(lat)
+        lat_sin = xp.sin(lat)
+        lat_cos = xp.cos(lat)
+        lat_tan2 = (lat_sin / lat_cos)**2
+        lat_tan4 = lat_tan2**2
+
+        n = R / xp.sqrt(1 - E * lat_sin**2)
+        c = E_P2 * lat_cos**2
+        a = lat_cos * ((xp.radians(lng) - central + xp.pi) % (2*xp.pi) - xp.pi)
+
+        m = R * (M1 * lat - M2 * xp.sin(2*lat) + M3 * xp.sin(4*lat) - M4 * xp.sin(6*lat))
+        x = K0 * n * (a + a**3 / 6 * (1 - lat_tan2 + c) +
+                      a**5 / 120 * (5 - 18*lat_tan2 + lat_tan4 + 72*c - 58*E_P2))
+        y = K0 * (m + n * lat_sin / lat_cos * (
+                    a**2 / 2 + a**4 / 24 * (5 - lat_tan2 + 9*c + 4*c**2) +
+                    a**6 / 720 * (61 - 58*lat_tan2 + lat_tan4 + 600*c - 330*E_P2)))
+        return x, y
+
+    x0, y0 = tm(*latlng_origin, xp=math)
+
+    def project(lat, lng):
+        if np.ndim(lat) == 0 and np.ndim(lng) == 0:
+            x, y = tm(float(lat), float(lng), math)
+        else:
+            x, y = tm(lat, lng)
+        return x - x0, y - y0
+    return project
+
+def split(latlngs):
+    """
+    :param latlngs: tuple (lat, lng) or n x 2 array like, None is NaN
+    :return: tuple (lat, lng) of numpy arrays
+    """
+    a = np.asarray(latlngs, np.float64)
+    return a[..., 0], a[..., 1]
+
+def origin(latlng_origin, pid_origin):
+    if latlng_origin:
+        return latlng_origin
+    elif pid_origin:
+        return Panorama(pid_origin).getGPS()
+    raise ValueError("One of the arguments 'latlang_origin' or 'pid_origin' must be given.")
+
+
 def circle(latlng_origin=None, pid_origin=None, radius=15):
     """
     Returns a validator function for a Panorama. which Returns True if
@@ -10,22 +88,30 @@ def circle(latlng_origin=None, pid_origin=None, radius=15):
     :param latlng_0: tuple (lat, lng) - center GPS
     :param r: float - radius in meters
     :return: validator(panorama) - given Panorama it returns True
-             if the Panorama is inside the circle
+             if the Panorama is inside the circle. Its attribute
+             distance(latlng) gives meters from the center,
+             precheck(latlng, slack) tells if a position may be
+             inside, slack in meters widens the area. Both accept
+             n x 2 arrays, validate_many(latlngs) checks n positions.
     """
-    if latlng_origin:
-        (easting, northing, z_number, z_letter) = utm.from_latlon(latlng_origin[0], latlng_origin[1])
-    elif pid_origin:
-        latlng_origin = Panorama(pid_origin).getGPS()
-        (easting, northing, z_number, z_letter) = utm.from_latlon(latlng_origin[0], latlng_origin[1])
-    else:
-        raise ValueError("One of the arguments 'latlang_origin' or 'pid_origin' must be given.")
+    project = projection(origin(latlng_origin, pid_origin))
+
+    def distance(ll):
+        x, y = project(*split(ll))
+        return np.hypot(x, y)
 
     def isClose(p):
-        ll = p.getGPS()
-        (est, nth, zn, zl) = utm.from_latlon(ll[0], ll[1], force_zone_number=z_number)
-        x, y = est-easting, nth-northing
-        d = sqrt(x**2+y**2)
-        return d < radius
+        return bool(precheck(p.getGPS()))
+
+    def precheck(ll, slack=0):
+        with np.errstate(invalid='ignore'):     # NaN, unknown position
+            return distance(ll) < radius + slack
+
+    def validate_many(latlngs):
+        return precheck(np.asarray(latlngs, np.float64).reshape(-1, 2))
+    isClose.distance = distance
+    isClose.precheck = precheck
+    isClose.validate_many = validate_many
     return isClose
 
 
@@ -38,22 +124,31 @@ def box(latlng_origin=None, pid_origin=None, width=15, height=15):
     :param w: float - width in meters
     :param h: float - height in meters
     :return: validator(Panorama) - given a Panorama it returns True
-             if the panorama is inside the box
+             if the panorama is inside the box. Its attribute
+             distance(latlng) gives meters from the center,
+             precheck(latlng, slack) tells if a position may be
+             inside, slack in meters widens the area. Both accept
+             n x 2 arrays, validate_many(latlngs) checks n positions.
     """
-    if latlng_origin:
-        (easting, northing, z_number, z_letter) = utm.from_latlon(latlng_origin[0], latlng_origin[1])
-    elif pid_origin:
-        latlng_origin = Panorama(pid_origin).getGPS()
-        (easting, northing, z_number, z_letter) = utm.from_latlon(latlng_origin[0], latlng_origin[1])
-    else:
-        raise ValueError("One of the arguments 'latlang_origin' or 'pid_origin' must be given.")
+    project = projection(origin(latlng_origin, pid_origin))
 
+    def distance(ll):
+        x, y = project(*split(ll))
+        return np.hypot(x, y)
 
     def isClose(p):
-        ll = p.getGPS()
-        (est, nth, zn, zl) = utm.from_latlon(ll[0], ll[1], force_zone_number=z_number)
-        x, y = est-easting, nth-northing
-        return abs(x) < w/2 and abs(y) < h/2
+        return bool(precheck(p.getGPS()))
+
+    def precheck(ll, slack=0):
+        x, y = project(*split(ll))
+        with np.errstate(invalid='ignore'):
+            return (np.abs(x) < width/2. + slack) & (np.abs(y) < height/2. + slack)
+
+    def validate_many(latlngs):
+        return precheck(np.asarray(latlngs, np.float64).reshape(-1, 2))
+    isClose.distance = distance
+    isClose.precheck = precheck
+    isClose.validate_many = validate_many
     return isClose
 
 def gpsbox(topleft, btmright):
@@ -62,12 +157,248 @@ def gpsbox(topleft, btmright):
     :param topleft: tuple (lat,lng) - top left corner
     :param btmright: tuple (lat, lng) - bottom right
     :return: validator(Panorama) - given a Panorama it returns True
-             if the Panorama is inside the gps box.
+             if the Panorama is inside the gps box. Its attribute
+             distance(latlng) gives approx. meters from the box center,
+             precheck(latlng, slack) tells if a position may be
+             inside, slack in meters widens the area. Both accept
+             n x 2 arrays, validate_many(latlngs) checks n positions.
     """
+    center = ((topleft[0] + btmright[0]) / 2., (topleft[1] + btmright[1]) / 2.)
+    kx = R_EARTH * radians(1) * cos(radians(center[0]))
+    ky = R_EARTH * radians(1)
+
+    def distance(ll):
+        # equirectangular approximation, fine at box scale
+        lt, ln = split(ll)
+        return np.hypot((ln-center[1]) * kx, (lt-center[0]) * ky)
+
     def isClose(p):
         lt,ln = p.getGPS()
+        if lt is None or ln is None:
+            return False
         return lt<=topleft[0] and lt>btmright[0] and ln>=topleft[1] and ln<btmright[1]
+
+    def precheck(ll, slack=0):
+        lt, ln = split(ll)
+        dy, dx = slack / ky, slack / kx
+        with np.errstate(invalid='ignore'):
+            return (lt<=topleft[0]+dy) & (lt>btmright[0]-dy) & (ln>=topleft[1]-dx) & (ln<btmright[1]+dx)
+
+    def validate_many(latlngs):
+        return precheck(np.asarray(latlngs, np.float64).reshape(-1, 2))
+    isClose.distance = distance
+    isClose.precheck = precheck
+    isClose.validate_many = validate_many
     return isClose
 
 
+class PolygonIndex:
+    """
+    Even-odd point in polygon test over many rings (outer boundaries
+    and holes) with edges indexed in horizontal bands. A point is
+    tested only against edges of its band, about a constant number
+    for typical boundaries, instead of all edges.
+    """
+    edges_per_band = 4
+
+    def __init__(self, rings):
+        """
+        :param rings: list of numpy.ndarray - k x 2 closed or open
+                      rings of planar (x, y) vertices
+        """
+        e = np.concatenate([np.hstack([r, np.roll(r, -1, axis=0)]) for r in rings])
+        e = e[(e[:, 1] != e[:, 3]) | (e[:, 0] != e[:, 2])]      # no degenerate edges
+        self.xmin, self.ymin = e[:, [0, 2]].min(), e[:, [1, 3]].min()
+        self.xmax, self.ymax = e[:, [0, 2]].max(), e[:, [1, 3]].max()
+
+        m = len(e)
+        self.n_bands = max(1, m // self.edges_per_band)
+        self.h = (self.ymax - self.ymin) / self.n_bands or 1.
+        b0, b1 = self.band(np.minimum(e[:, 1], e[:, 3])), self.band(np.maximum(e[:, 1], e[:, 3]))
+
+        # edges sorted by band, an edge is in every band it spans
+        counts = b1 - b0 + 1
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        bands = np.repeat(b0, counts) + np.arange(counts.sum()) - first
+        order = np.argsort(bands, kind='mergesort')
+        self.e = e[np.repeat(np.arange(m), counts)[order]]
+        self.starts = np.searchsorted(bands[order], np.arange(self.n_bands + 1))
+
+    def band(self, y):
+        return np.clip(((y - self.ymin) / self.h).astype(np.intp), 0, self.n_bands - 1)
+
+    def edges(self, b0, b1=None):
+        # edges of bands b0..b1
+        return self.e[self.starts[b0]:self.starts[(b0 if b1 is None else b1) + 1]]
+
+    def contains(self, x, y):
+        """
+        :param x, y: numpy.ndarray - point coordinates
+        :return: numpy.ndarray - boolean, True inside
+        """
+        x, y = np.atleast_1d(x), np.atleast_1d(y)
+        if len(x) == 1:
+            return np.array([self._containsOne(float(x[0]), float(y[0]))])
+        out = np.zeros(x.shape, bool)
+        with np.errstate(invalid='ignore'):
+            valid = (y >= self.ymin) & (y <= self.ymax) & (x >= self.xmin) & (x <= self.xmax)
+        idx = np.flatnonzero(valid)
+        bands = self.band(y[idx])
+        for b in np.unique(bands):
+            i = idx[bands == b]
+            x1, y1, x2, y2 = self.edges(b).T
+            px, py = x[i, None], y[i, None]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cross = ((y1 > py) != (y2 > py)) & (px < x1 + (py - y1) * (x2 - x1) / (y2 - y1))
+            out[i] = cross.sum(axis=1) % 2 == 1
+        return out
+
+    def _containsOne(self, px, py):
+        # one point, plain Python over the few edges of its band
+        if not (self.ymin <= py <= self.ymax and self.xmin <= px <= self.xmax):
+            return False                    # also NaN
+        b = min(int((py - self.ymin) / self.h), self.n_bands - 1)
+        inside = False
+        for x1, y1, x2, y2 in self.edges(b).tolist():
+            if (y1 > py) != (y2 > py) and px < x1 + (py - y1) * (x2 - x1) / (y2 - y1):
+                inside = not inside
+        return inside
+
+    def near(self, x, y, d):
+        """
+        :param x, y: numpy.ndarray - point coordinates
+        :param d: float - max. distance
+        :return: numpy.ndarray - boolean, True if an edge is closer than d
+        """
+        x, y = np.atleast_1d(x), np.atleast_1d(y)
+        out = np.zeros(x.shape, bool)
+        for i in xrange(len(x)):
+            px, py = x[i], y[i]
+            if not (self.ymin - d <= py <= self.ymax + d and self.xmin - d <= px <= self.xmax + d):
+                continue
+            x1, y1, x2, y2 = self.edges(self.band(py - d), self.band(py + d)).T
+            dx, dy = x2 - x1, y2 - y1
+            t = np.clip(((px - x1) * dx + (py - y1) * dy) / (dx**2 + dy**2), 0, 1)
+            out[i] = (np.hypot(x1 + t*dx - px, y1 + t*dy - py) < d).any()
+        return out
+
+
+def loadPolygons(fname):
+    """
+    Reads polygons from GeoJSON (Polygon, MultiPolygon, Feature,
+    FeatureCollection, GeometryCollection) or WKT (POLYGON,
+    MULTIPOLYGON) file.
+    :param fname: string - filename
+    :return: list of polygons, a polygon is a list of rings (outer
+             boundary and holes), a ring is a list of (lng, lat)
+    """
+    with open(fname) as f:
+        text = f.read()
+    if text.lstrip().startswith('{'):
+        return _geojsonPolygons(json.loads(text))
+    return _wktPolygons(text)
 
+def _geojsonPolygons(obj):
+    t = obj.get('type')
+    if t == 'FeatureCollection':
+        return [p for f in obj['features'] for p in _geojsonPolygons(f)]
+    if t == 'Feature':
+        return _geojsonPolygons(obj['geometry']) if obj.get('geometry') else []
+    if t == 'GeometryCollection':
+        return [p for g in obj['geometries'] for p in _geojsonPolygons(g)]
+    if t == 'Polygon':
+        return [obj['coordinates']]
+    if t == 'MultiPolygon':
+        return obj['coordinates']
+    return []
+
+def _wktPolygons(text):
+    polygons = []
+    tokens = re.findall(r'[A-Za-z]+|\(|\)|,|[-+0-9.eE]+', text)
+    i = 0
+    while i < len(tokens):
+        kw = tokens[i].upper()
+        i += 1
+        if kw not in ('POLYGON', 'MULTIPOLYGON'):
+            continue
+        while i < len(tokens) and tokens[i] != '(':
+            i += 1                          # Z, M, ZM
+        if i == len(tokens):
+            break
+        items, i = _wktList(tokens, i)
+        polygons.extend([items] if kw == 'POLYGON' else items)
+    return polygons
+
+def _wktList(tokens, i):
+    # parses '(' ... ')' at i, coordinates separated by spaces, items by commas
+    items, point = [], []
+    i += 1
+    while tokens[i] != ')':
+        tok = tokens[i]
+        if tok == '(':
+            sub, i = _wktList(tokens, i)
+            items.append(sub)
+            continue
+        if tok == ',':
+            if point:
+                items.append(point)
+            point = []
+        else:
+            point.append(float(tok))
+        i += 1
+    if point:
+        items.append(point)
+    return items, i + 1
+
+
+def polygon(fname, latlng_origin=None, pid_origin=None):
+    """
+    Returns a validator of Panorama that returns True if the Panorama
+    is inside an area given by polygons (with holes) in a GeoJSON or
+    WKT file, e.g. city boundaries. Edges are indexed, see
+    PolygonIndex, a test is near O(1) even for thousands of vertices.
+    :param fname: string - GeoJSON or WKT file, lng, lat coordinates
+    :param latlng_origin: tuple (lat, lng) - origin of distance(),
+                          e.g. the crawl start, default center of
+                          the area bounding box
+    :param pid_origin: string - pano id of the origin
+    :return: validator(Panorama) - given a Panorama it returns True
+             if the panorama is inside the area. Its attribute
+             distance(latlng) gives meters from the origin,
+             precheck(latlng, slack) tells if a position may be
+             inside, slack in meters widens the area. Both accept
+             n x 2 arrays, validate_many(latlngs) checks n positions.
+    """
+    rings = [np.asarray(r, np.float64)[:, :2] for p in loadPolygons(fname) for r in p]
+    if not rings:
+        raise ValueError('No polygon found in %s' % (fname,))
+
+    if not latlng_origin and not pid_origin:
+        lng, lat = np.concatenate(rings).T
+        latlng_origin = ((lat.min() + lat.max()) / 2., (lng.min() + lng.max()) / 2.)
+    project = projection(origin(latlng_origin, pid_origin))
+    index = PolygonIndex([np.column_stack(project(r[:, 1], r[:, 0])) for r in rings])
+
+    def distance(ll):
+        x, y = project(*split(ll))
+        return np.hypot(x, y)
+
+    def isClose(p):
+        return bool(precheck(p.getGPS()))
+
+    def precheck(ll, slack=0):
+        lat, lng = split(ll)
+        x, y = project(lat, lng)
+        x, y = np.atleast_1d(x), np.atleast_1d(y)
+        inside = index.contains(x, y)
+        if slack > 0:
+            i = np.flatnonzero(~inside)
+            inside[i] = index.near(x[i], y[i], slack)
+        return inside if lat.ndim else inside[0]
+
+    def validate_many(latlngs):
+        return precheck(np.asarray(latlngs, np.float64).reshape(-1, 2))
+    isClose.distance = distance
+    isClose.precheck = precheck
+    isClose.validate_many = validate_many
+    return isClose